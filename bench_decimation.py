@@ -0,0 +1,75 @@
+import sys
+import time
+import numpy as np
+
+from modules.spectral import SpectralEngine
+
+# Synthetic night: pink noise plus alpha/sigma rhythms on the 7 EEG channels, 30s epochs at 200Hz.
+SFREQ = 200.0
+EPOCHS = 600
+CHANNELS = 7
+TARGETS = [0, 100, 64]
+TOLERANCE = 0.01
+FMIN = 0.5
+FMAX = 30.0
+BANDS = {
+    "delta": [0.5, 4.5],
+    "theta": [4.5, 8.5],
+    "alpha": [8.5, 11.5],
+    "sigma": [11.5, 15.5],
+    "beta": [15.5, 30],
+}
+
+def synthetic(seed = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    samples = int(EPOCHS * 30 * SFREQ)
+
+    spectrum = np.fft.rfft(rng.normal(size=(CHANNELS, samples)))
+    freqs = np.fft.rfftfreq(samples, 1.0 / SFREQ)
+    spectrum[:, 1:] /= np.sqrt(freqs[1:])
+
+    times = np.arange(samples) / SFREQ
+    data = np.fft.irfft(spectrum, samples) + np.sin(2 * np.pi * 10 * times) + 0.3 * np.sin(2 * np.pi * 13 * times)
+
+    return data * 1e-5
+
+def features(engine: SpectralEngine, data: np.ndarray, target: float):
+    # Same steps as EdfParser.featuresPerEvent: decimate the continuous signals, split into 30s epochs, PSD, band features.
+    factor = SpectralEngine.decimationFactor(SFREQ, target, FMAX)
+    sfreq = SFREQ / factor
+
+    decimated = SpectralEngine.decimate(data, SFREQ, factor, FMAX)
+    size = int(round(30 * sfreq))
+    count = decimated.shape[-1] // size
+    epochs = decimated[:, :count * size].reshape(CHANNELS, count, size).transpose(1, 0, 2)
+
+    psds, freqs = engine.psd(epochs, sfreq, fmin=FMIN, fmax=FMAX)
+    return SpectralEngine.bandFeatures(psds, freqs, BANDS)[0], sfreq
+
+def bench():
+    engine = SpectralEngine("multitaper")
+    data = synthetic()
+
+    reference = None
+    failed = False
+    for target in TARGETS:
+        # Warm up the taper and filter caches, as in any session but the first.
+        features(engine, data[:, :int(30 * SFREQ)], target)
+
+        start = time.perf_counter()
+        X, sfreq = features(engine, data, target)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference, base = X, elapsed
+
+        error = np.max(np.abs(X - reference) / np.abs(reference))
+        failed = failed or error > TOLERANCE
+
+        print(f"target {target:>3} Hz -> {sfreq:6.2f} Hz: {elapsed:.3f}s ({base / elapsed:.2f}x), features {X.shape}, max relative error {error:.2e}")
+
+    if failed:
+        print(f"Features out of tolerance ({TOLERANCE})")
+        sys.exit(1)
+
+bench()
@@ -0,0 +1,81 @@
+import atexit
+import os
+import sys
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Simulated training step, the time the model would spend on each batch while the input pipeline works ahead.
+STEP_MS = float(os.getenv("BENCH_STEP_MS", 5))
+BATCHES = int(os.getenv("BENCH_BATCHES", 500))
+
+def stalls(batches):
+    """ (batches, seconds waiting for the next batch, total seconds) over at most BATCHES batches. """
+    waited = 0
+    count = 0
+    start = time.perf_counter()
+    iterator = iter(batches)
+
+    while count < BATCHES:
+        requested = time.perf_counter()
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+
+        waited += time.perf_counter() - requested
+        count += 1
+
+        time.sleep(STEP_MS / 1000)
+
+    return count, waited, time.perf_counter() - start
+
+def sources(model: str):
+    # Tables must already be populated (by mlp.py / nn.py), the first batch includes the loading time.
+    if model == "mlp":
+        from modules.db_mlp import Db
+
+        db = Db()
+        batchSize = 64
+
+        def generator(loader):
+            db.loader = loader
+            return db.readChunks(batchSize, 1)
+
+        return [
+            ("generator (query)", lambda: generator("query")),
+            ("generator (bulk)", lambda: generator("bulk")),
+            ("tf.data", lambda: db.dataset(batchSize))
+        ]
+
+    from modules.db import Db
+
+    db = Db()
+    batchSize = 64
+    atexit.register(db.clearDatasetCaches)
+
+    def cached():
+        # The first epoch fills the cache (DATASET_CACHE_DIR), the one measured reads from it in a new order.
+        dataset = db.dataset(batchSize)
+        for _ in dataset:
+            pass
+
+        return dataset
+
+    return [
+        ("generator", lambda: db.readChunks(batchSize, 1)),
+        ("tf.data", lambda: db.dataset(batchSize, cacheDir=""))
+    ] + ([("tf.data (cached)", cached)] if os.getenv("DATASET_CACHE_DIR") else [])
+
+def bench(model: str):
+    print(f"{model}: {BATCHES} batches max, {STEP_MS:.1f} ms per training step")
+
+    base = None
+    for name, source in sources(model):
+        count, waited, elapsed = stalls(source())
+        base = waited if base is None else base
+
+        print(f"{name:>18}: {count} batches in {elapsed:.2f}s, input stall {waited:.2f}s ({100 * waited / max(elapsed, 1e-9):.1f}% of the time, {1000 * waited / max(count, 1):.2f} ms/batch, {base / max(waited, 1e-9):.2f}x)")
+
+bench(sys.argv[1] if len(sys.argv) > 1 else "mlp")
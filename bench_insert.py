@@ -0,0 +1,72 @@
+import os
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+from modules.db_mlp import Db, FeatureSink
+
+load_dotenv()
+
+# Synthetic sessions shaped as EdfParser's output: ~1000 epochs of 35 band features per night.
+SESSIONS = int(os.getenv("BENCH_SESSIONS", 40))
+EPOCHS = int(os.getenv("BENCH_EPOCHS", 1000))
+TABLE = "bench_samples"
+
+def sessions(seed = 0):
+    rng = np.random.default_rng(seed)
+    return [(rng.random((EPOCHS, len(Db.featureColumns))), rng.integers(0, 4, EPOCHS)) for _ in range(SESSIONS)]
+
+def insert(db: Db, data: list, writer: str, batched: bool) -> float:
+    db.writer = writer
+
+    with db.conn.cursor() as cursor:
+        cursor.execute(f"TRUNCATE TABLE {TABLE};")
+    db.conn.commit()
+
+    start = time.perf_counter()
+    if batched:
+        sink = FeatureSink(db)
+        for features, labels in data:
+            sink.add(features, labels, TABLE)
+        sink.flush()
+    else:
+        # One COPY and one commit per session, as before the sink.
+        for features, labels in data:
+            db.insertFeatures(features, labels, TABLE)
+
+    return time.perf_counter() - start
+
+def bench():
+    db = Db()
+    data = sessions()
+    rows = SESSIONS * EPOCHS
+
+    with db.conn.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (LIKE samples INCLUDING DEFAULTS);")
+    db.conn.commit()
+
+    expected = np.concatenate([features for features, _ in data]).astype(np.float32)
+    labels = np.concatenate([labels for _, labels in data])
+
+    # With DB_MLP_SCHEMA=packed the scratch table is a packed one and every writer inserts blobs.
+    print(f"{SESSIONS} sessions of {EPOCHS} rows, schema {db.schema}")
+
+    try:
+        base = None
+        for writer, batched in [("csv", False), ("binary", False), ("binary", True)]:
+            elapsed = insert(db, data, writer, batched)
+            base = elapsed if base is None else base
+
+            # Every writer must leave the same rows in the table.
+            features, stored = db.loadRows(TABLE)
+            matches = np.array_equal(features, expected) and np.array_equal(stored, labels)
+
+            name = f"{writer}{' + sink' if batched else ''}"
+            print(f"{name:>13}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:,.0f} rows/s ({base / elapsed:.2f}x), rows match: {matches}")
+    finally:
+        with db.conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        db.conn.commit()
+        db.close()
+
+bench()
@@ -0,0 +1,76 @@
+import sys
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+from modules.edf import EdfParser
+
+# Synthetic nights written as EDF+ in memory: 1s records, noisy sinusoids as 16 bit samples.
+RECORDS = 3 * 3600
+EPOCHS = 300
+WINDOWS = [1, 7, 120]
+CHANNELS = ["C3-M2", "O1-M2", "F4-M1"]
+RECORDINGS = {
+    "full rate": [256, 256, 256],
+    "mixed rate": [256, 256, 128],
+}
+STAGES = ["Sleep_stage_W", "Sleep_stage_N1", "Sleep_stage_N2", "Sleep_stage_N3", "Sleep_stage_R"]
+
+def field(value, size: int) -> bytes:
+    return str(value).ljust(size).encode()
+
+def edf(rates: list, seed = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    count = len(rates)
+
+    header = field(0, 8) + field("X X X X", 80) + field("Startdate 01-JAN-2020 X X X", 80) + field("01.01.20", 8) + field("22.30.00", 8)
+    header += field(256 * (count + 1), 8) + field("EDF+C", 44) + field(RECORDS, 8) + field(1, 8) + field(count, 4)
+    for values, size in [(CHANNELS, 16), ([""] * count, 80), (["uV"] * count, 8), ([-3200] * count, 8), ([3200] * count, 8),
+                         ([-32768] * count, 8), ([32767] * count, 8), ([""] * count, 80), (rates, 8), ([""] * count, 32)]:
+        header += b"".join(field(value, size) for value in values)
+
+    signals = []
+    for position, rate in enumerate(rates):
+        times = np.arange(RECORDS * rate) / rate
+        signal = 8000 * np.sin(2 * np.pi * (position + 1) * 3 * times) + rng.normal(0, 3000, times.size)
+        signals.append(signal.clip(-32768, 32767).astype("<i2").reshape(RECORDS, rate))
+
+    return header + np.concatenate(signals, axis=1).tobytes()
+
+def annotations() -> pd.DataFrame:
+    start = datetime.datetime(2020, 1, 1, 22, 31)
+    rows = [("22:30:30", "Lights_off", 0.0)]
+    rows += [((start + datetime.timedelta(seconds=30 * epoch)).strftime("%H:%M:%S"), STAGES[epoch % len(STAGES)], 30.0) for epoch in range(EPOCHS)]
+
+    return pd.DataFrame(rows, columns=["time", "event", "duration"])
+
+def bench():
+    picks = pd.DataFrame({ "name": CHANNELS })
+    failed = False
+
+    for name, rates in RECORDINGS.items():
+        parser = EdfParser(edf(rates), picks=CHANNELS)
+        parser.setAnottations(annotations())
+
+        start = time.perf_counter()
+        reference, labels = parser.featuresPerEvent(picks)
+        base = time.perf_counter() - start
+
+        for epochsPerWindow in WINDOWS:
+            start = time.perf_counter()
+            windows = list(parser.iterFeatures(picks, epochsPerWindow))
+            elapsed = time.perf_counter() - start
+
+            X = np.concatenate([features for features, _ in windows])
+            y = np.concatenate([labels for _, labels in windows])
+            error = np.max(np.abs(X - reference)) if X.shape == reference.shape else np.inf
+            failed = failed or error > 0 or not np.array_equal(y, labels)
+
+            print(f"{name}, {epochsPerWindow:>3} epochs per window: {len(windows)} windows, {elapsed:.3f}s (whole night {base:.3f}s), features {X.shape}, max error {error:.2e}")
+
+    if failed:
+        print("iterFeatures differs from featuresPerEvent")
+        sys.exit(1)
+
+bench()
@@ -3,14 +3,13 @@ import sys
 import pandas as pd
 import os
 from botocore.exceptions import ClientError
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from modules.aws import AWS
 from modules.chann_selector import ChannSelector, MissingChannels
-from modules.edf import BadSamplingFreq
-from modules.mlp import MLPEegModel
-from modules.utils import Utils
-from modules.db_mlp import Db
+from modules.edf import BadSamplingFreq, EdfParser, FeatureBatcher
+from modules.feature_store import FeatureStore
+from modules.pipeline import Pipeline
+from modules.workers import ProcessWorkers
 
 from dotenv import load_dotenv
 
@@ -25,13 +24,32 @@ class IncompatibleCheckpoint(Exception):
 class ValidationElement(Exception):
     pass
 
-aws = AWS()
-utils = Utils()
-db = Db()
+# Opt-in store of the features already computed, sessions found there aren't downloaded again.
+store = FeatureStore(os.getenv("FEATURE_STORE_DIR"), EdfParser.featuresVersion()) if os.getenv("FEATURE_STORE_DIR") else None
 
-CHUNK_SIZE = 3
+DOWNLOAD_WORKERS = 3
+COMPUTE_WORKERS = 3
+IN_FLIGHT = 6
 CHUNKS_PER_TRAIN = 200
 
+# Opt-in: sessions are admitted while their estimated memory (EDF size * SESSION_MEMORY_FACTOR) fits in the budget,
+# up to MAX_IN_FLIGHT at once, instead of a fixed IN_FLIGHT.
+MEMORY_BUDGET = int(os.getenv("MEMORY_BUDGET_MB", 0)) * 1024 * 1024
+SESSION_MEMORY_FACTOR = float(os.getenv("SESSION_MEMORY_FACTOR", 2.0))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", 32))
+# EDF size assumed for sessions of sites missing from the manifest (AWS_MANIFEST), instead of asking the bucket.
+SESSION_SIZE_ESTIMATE = int(os.getenv("SESSION_SIZE_ESTIMATE_MB", 512)) * 1024 * 1024
+
+# "threads" or "processes", see ProcessWorkers.
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "threads")
+
+# Opt-in: PSDs of the sessions computed at the same time by the compute threads run together, see FeatureBatcher.
+PSD_BATCH_SESSIONS = min(int(os.getenv("EDF_PSD_BATCH_SESSIONS", 1)), COMPUTE_WORKERS)
+batcher = FeatureBatcher(PSD_BATCH_SESSIONS) if PSD_BATCH_SESSIONS > 1 and EXECUTION_MODE == "threads" else None
+
+# Opt-in: sessions decoded EDF_STREAM_EPOCHS epochs at a time (EdfParser.iterFeatures), unless their PSDs are batched.
+STREAM_EPOCHS = int(os.getenv("EDF_STREAM_EPOCHS", 0)) if os.getenv("EDF_EPOCHING", "numpy") == "numpy" else 0
+
 validation_set = [
     {
         "folder": "sub-S0001111192396",
@@ -142,18 +160,52 @@ def isValidation(folder, session, site):
     
     return False
 
-def parseData(folder, session, site, channels): 
-    
-    parser = aws.loadEegEdf(folder, session, site)
+def downloadData(folder, session, site, channels):
+
+    picks = channels["name"].to_list()
+
+    if store is not None:
+        stored = store.get(site, folder, session, picks)
+        if stored is not None:
+            return stored, None
+
     annotations = aws.loadEegAnnotationsCsv(folder, session, site)
+    parser = aws.loadEegEdf(folder, session, site, picks=picks)
+
+    return None, (parser, annotations, channels, (site, folder, session, picks))
+
+def computeData(downloaded):
+
+    if downloaded is None:
+        return None, None
 
-    parser.setAnottations(annotations)
-    features, labels = parser.featuresPerEvent(channels)
-    parser.purge()
+    stored, pending = downloaded
+
+    if stored is not None:
+        return stored
+
+    parser, annotations, channels, key = pending
+
+    try:
+        parser.setAnottations(annotations)
+        if batcher is not None:
+            features, labels = batcher.features(*parser.epochData(channels))
+        elif STREAM_EPOCHS > 0:
+            features, labels = parser.streamedFeatures(channels, STREAM_EPOCHS)
+        else:
+            features, labels = parser.featuresPerEvent(channels)
+    finally:
+        parser.purge()
+
+    if store is not None:
+        store.put(*key, features, labels)
 
     return features, labels
+
+def parseData(folder, session, site, channels): 
+    return computeData(downloadData(folder, session, site, channels))
     
-def getInfoTask(row: pd.Series):
+def reserveTask(row: pd.Series):
     folder = row["BidsFolder"]
     session = row["SessionID"]
     site = row["SiteID"]
@@ -163,15 +215,49 @@ def getInfoTask(row: pd.Series):
 
     if db.isTest(folder, session, site):
         raise TestReserve()
+
+    return folder, session, site
+
+def getInfoTask(row: pd.Series):
+    folder, session, site = reserveTask(row)
     
     channels = ChannSelector().selectEeg(aws.loadEegChannelsTsv(folder, session, site))
 
     if row['HasAnnotations'] == 'Y':    
                 
-        return parseData(folder, session, site, channels)
+        return downloadData(folder, session, site, channels)
     
     else:
-        return None, None
+        return None
+
+def parseTask(folder, session, site, hasAnnotations):
+    # Runs in a worker process, end to end: channels, download and features.
+    channels = ChannSelector().selectEeg(aws.loadEegChannelsTsv(folder, session, site))
+
+    return parseData(folder, session, site, channels) if hasAnnotations else (None, None)
+
+def processTask(row: pd.Series):
+    # The DB is only used from the parent, workers get the rows already checked.
+    folder, session, site = reserveTask(row)
+
+    return workers.call(parseTask, folder, session, site, row['HasAnnotations'] == 'Y')
+
+def sessionCost(row: pd.Series) -> int:
+    # Runs in the admission loop: no request to the bucket, and reserved rows (rejected right away) cost nothing.
+    if row['HasAnnotations'] != 'Y':
+        return 0
+
+    try:
+        reserveTask(row)
+    except (ValidationElement, TestReserve):
+        return 0
+
+    return int(aws.getEegEdfSize(row["BidsFolder"], row["SessionID"], row["SiteID"], SESSION_SIZE_ESTIMATE) * SESSION_MEMORY_FACTOR)
+
+def startWorker():
+    # Connections are never shared with the parent, every worker opens its own.
+    global aws
+    aws = AWS()
 
 def populateValidation():
 
@@ -188,13 +274,18 @@ def populateValidation():
             site = validation["site"]
 
             channels = ChannSelector().selectEeg(aws.loadEegChannelsTsv(folder, session, site))
-            features, labels = parseData(folder, session, site, channels)
-            db.insertFeatures(features, labels, "validation")
+            if workers is None:
+                features, labels = parseData(folder, session, site, channels)
+            else:
+                features, labels = workers.call(parseData, folder, session, site, channels)
+
+            sink.add(features, labels, "validation", Db.sessionKey(folder, session, site))
 
         except Exception as ex:
             print(f"Exception populating validation set %s: %s"%(validation["folder"], ex))
             sys.exit(1)
 
+    sink.flush()
     print("Populated validation set.")
 
 def recoverState():
@@ -202,7 +293,7 @@ def recoverState():
         with open(os.getenv("MODEL_CHECKPOINT_DIR") + "mlp_eeg.chunks", "r") as chunksFile:
             chunksInfo = chunksFile.readline()
             chunkParts = chunksInfo.split("=")
-            if chunkParts[0] != "CHUNKS":
+            if chunkParts[0] not in ["ROWS", "CHUNKS"]:
                 raise IncompatibleCheckpoint()
             
             insertedInfo = chunksFile.readline()
@@ -211,66 +302,106 @@ def recoverState():
 
             if inserted == 0:
                 db.flushData()
+
+            # Checkpoints written before the pipeline counted chunks of 3 rows.
+            rows = int(chunkParts[-1]) * (3 if chunkParts[0] == "CHUNKS" else 1)
             
-            return int(chunkParts[-1]), inserted
+            return rows, inserted
 
     except FileNotFoundError:
         return 0, 0
 
 def trainMLP():
     model = MLPEegModel()
-    getChunk = utils.chunkDataframe(pd.read_csv('bdsp_psg_master_20231101.csv'), CHUNK_SIZE)
-    chunksToSkip, inserted = recoverState()
-    chunks = 0
-
-    for chunk in getChunk:
-        chunks += 1
-
-        if chunksToSkip < chunks:
-            with ThreadPoolExecutor(max_workers=CHUNK_SIZE) as executor:
-                futureToRow = {executor.submit(getInfoTask, row): row for _, row in chunk.iterrows()}
-                for future in as_completed(futureToRow):
-                    row = futureToRow[future]
-                    try:
-                        
-                        features, labels = future.result()
-
-                        if features is not None:
-                            db.insertFeatures(features, labels)
-                            inserted += 1
-
-                        if inserted == CHUNKS_PER_TRAIN:
-                            cat_acc, val_cat_acc, loss, val_loss = model.fit()
-                            print(f"\033[1mAccuracy: {cat_acc}, Validation accuracy: {val_cat_acc}, Loss: {loss}, Validation loss: {val_loss}\033[0m")
-                            model.save(chunks, 0, "CHUNKS")
-
-                            inserted = 0
-                            db.flushData()
-
-                    except ValidationElement:
-                        print(f"Skipped validation element: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                        pass
-                    except TestReserve:
-                        print(f"Reserved for test: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                        #db.insertTest(row["BidsFolder"], row["SessionID"], row["SiteID"])
-                        pass
-                    except ClientError:
-                        print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                        pass
-                    except MissingChannels as ex:
-                        print(f"Missing channels: {row["BidsFolder"]}, session: {row["SessionID"]}", ex)
-                        pass
-                    except BadSamplingFreq as ex:
-                        print(f"Bad sampling frequency ({ex}): {row["BidsFolder"]}, session: {row["SessionID"]}")
-                        pass
-                    except Exception as ex:
-                        print(f"Exception %s: %s"%(row["BidsFolder"], ex))
-                        pass
+    rowsToSkip, inserted = recoverState()
+    rows = pd.read_csv('bdsp_psg_master_20231101.csv').iloc[rowsToSkip:]
+
+    if workers is None and MEMORY_BUDGET == 0:
+        pipeline = Pipeline(getInfoTask, computeData, DOWNLOAD_WORKERS, COMPUTE_WORKERS, IN_FLIGHT)
+    elif workers is None:
+        pipeline = Pipeline(getInfoTask, computeData, MAX_IN_FLIGHT, COMPUTE_WORKERS, MAX_IN_FLIGHT, sessionCost, MEMORY_BUDGET)
+    else:
+        # Each thread waits on one worker process, results reach the sink (DB writes) in this process.
+        pipeline = Pipeline(processTask, None, workers.workers, 1, workers.workers, sessionCost, MEMORY_BUDGET)
+
+    # In input order, so the checkpoint (rows up to the watermark) never leaves inserted sessions behind it.
+    for row, future in pipeline.run((row for _, row in rows.iterrows()), True):
+        try:
             
-            model.save(chunks, inserted, "CHUNKS", False, True)
+            features, labels = future.result()
 
-    model.save(chunks, inserted, "CHUNKS", True)
+            if features is not None:
+                sink.add(features, labels, "samples", Db.sessionKey(row["BidsFolder"], row["SessionID"], row["SiteID"]))
+                inserted += 1
+
+            if inserted == CHUNKS_PER_TRAIN:
+                sink.flush()
+                cat_acc, val_cat_acc, loss, val_loss = model.fit()
+                print(f"\033[1mAccuracy: {cat_acc}, Validation accuracy: {val_cat_acc}, Loss: {loss}, Validation loss: {val_loss}\033[0m")
+                model.save(rowsToSkip + pipeline.watermark, 0)
+
+                inserted = 0
+                db.flushData()
+
+        except ValidationElement:
+            print(f"Skipped validation element: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except TestReserve:
+            print(f"Reserved for test: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            #db.insertTest(row["BidsFolder"], row["SessionID"], row["SiteID"])
+            pass
+        except ClientError:
+            print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except MissingChannels as ex:
+            print(f"Missing channels: {row["BidsFolder"]}, session: {row["SessionID"]}", ex)
+            pass
+        except BadSamplingFreq as ex:
+            print(f"Bad sampling frequency ({ex}): {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except SinkFlushError:
+            # The sessions still buffered never reached the database, stop before a checkpoint skips them.
+            raise
+        except Exception as ex:
+            print(f"Exception %s: %s"%(row["BidsFolder"], ex))
+            pass
+
+        # Rows past the watermark are still in flight and none of them reached the sink, they'll be redone
+        # after a restart. Sessions still buffered in the sink aren't in the database yet, so only checkpoint
+        # once it's empty.
+        if sink.pending == 0:
+            model.save(rowsToSkip + pipeline.watermark, inserted, "ROWS", False, True)
+
+    sink.flush()
+    model.save(rowsToSkip + pipeline.watermark, inserted, "ROWS", True)
+
+    if MEMORY_BUDGET > 0:
+        print(f"Admission stats: {pipeline.stats()}")
+
+# Forked before the AWS client (boto3 and the manifest's SQLite connection) and the database connection
+# are opened and before TensorFlow is imported (modules.db_mlp and modules.mlp), workers inherit none of
+# them. Each worker builds its own AWS client (startWorker).
+workers = ProcessWorkers(initializer=startWorker) if EXECUTION_MODE == "processes" else None
+
+aws = AWS()
+
+from modules.db_mlp import Db, FeatureSink, SinkFlushError
+from modules.mlp import MLPEegModel
+
+db = Db()
+sink = FeatureSink(db)
 
 populateValidation()
 trainMLP()
-db.close()
\ No newline at end of file
+db.close()
+
+if workers is not None:
+    workers.shutdown()
+
+if aws.getCacheStats() is not None:
+    print(f"Cache stats: {aws.getCacheStats()}")
+
+if store is not None:
+    print(f"Feature store stats: {store.stats()}")
+
+print(f"Pool stats: {aws.getPoolStats()}")
@@ -1,31 +1,72 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
+import os
 from matplotlib import pyplot as plt
 import numpy as np
 from sklearn.metrics import ConfusionMatrixDisplay, classification_report, confusion_matrix
 from modules.aws import AWS
 from modules.chann_selector import ChannSelector
-from modules.mlp import MLPEegModel
-from modules.db_mlp import Db 
+from modules.edf import EdfParser, FeatureBatcher
+from modules.feature_store import FeatureStore
+from modules.pipeline import Pipeline
+from modules.workers import ProcessWorkers
 
-aws = AWS()
-model = MLPEegModel()
-db = Db()
+store = FeatureStore(os.getenv("FEATURE_STORE_DIR"), EdfParser.featuresVersion()) if os.getenv("FEATURE_STORE_DIR") else None
 
-def parseData(data): 
+# Sessions are computed by 3 threads, their PSDs can run together (EDF_PSD_BATCH_SESSIONS).
+PSD_BATCH_SESSIONS = min(int(os.getenv("EDF_PSD_BATCH_SESSIONS", 1)), 3)
+batcher = FeatureBatcher(PSD_BATCH_SESSIONS) if PSD_BATCH_SESSIONS > 1 and os.getenv("EXECUTION_MODE", "threads") == "threads" else None
+
+# Opt-in: sessions decoded EDF_STREAM_EPOCHS epochs at a time (EdfParser.iterFeatures), unless their PSDs are batched.
+STREAM_EPOCHS = int(os.getenv("EDF_STREAM_EPOCHS", 0)) if os.getenv("EDF_EPOCHING", "numpy") == "numpy" else 0
+
+def downloadData(data): 
 
     folder, session, site = data
 
     channels = ChannSelector().selectEeg(aws.loadEegChannelsTsv(folder, session, site))
+    picks = channels["name"].to_list()
+
+    if store is not None:
+        stored = store.get(site, folder, session, picks)
+        if stored is not None:
+            return stored, None
     
-    parser = aws.loadEegEdf(folder, session, site)
+    parser = aws.loadEegEdf(folder, session, site, picks=picks)
     annotations = aws.loadEegAnnotationsCsv(folder, session, site)
 
-    parser.setAnottations(annotations)
-    features, labels = parser.featuresPerEvent(channels)
-    parser.purge()
+    return None, (parser, annotations, channels, (site, folder, session, picks))
+
+def computeData(downloaded):
+
+    stored, pending = downloaded
+
+    if stored is not None:
+        return stored
+
+    parser, annotations, channels, key = pending
+
+    try:
+        parser.setAnottations(annotations)
+        if batcher is not None:
+            features, labels = batcher.features(*parser.epochData(channels))
+        elif STREAM_EPOCHS > 0:
+            features, labels = parser.streamedFeatures(channels, STREAM_EPOCHS)
+        else:
+            features, labels = parser.featuresPerEvent(channels)
+    finally:
+        parser.purge()
+
+    if store is not None:
+        store.put(*key, features, labels)
 
     return features, labels
+
+def parseTask(data):
+    # Runs in a worker process, see ProcessWorkers.
+    return computeData(downloadData(data))
+
+def startWorker():
+    global aws
+    aws = AWS()
 #124
 def populateTest(): 
 
@@ -35,25 +76,58 @@ def populateTest():
         print("Skipping tests population")
         return
     
-    page = 0
-    for data in db.paginateTest():
-        with ThreadPoolExecutor(max_workers=len(data)) as executor:
-            futureToRow = {executor.submit(parseData, row): row for row in data}
-            for future in as_completed(futureToRow):
-                row = futureToRow[future]
-                try:
-                    
-                    features, labels = future.result()
-                    db.insertFeatures(features, labels, "test_data")
-                        
-                except Exception as ex:
-                    print(f"Exception %s: %s"%(row[0], ex))
-                    pass
-
-        print(f"PAGE {page} DONE!")
-        page += 1
+    if workers is None:
+        pipeline = Pipeline(downloadData, computeData, 3, 3, 6)
+    else:
+        pipeline = Pipeline(lambda data: workers.call(parseTask, data), None, workers.workers, 1, workers.workers)
+
+    done = 0
+    for row, future in pipeline.run(row for data in db.paginateTest() for row in data):
+        try:
+            
+            features, labels = future.result()
+            sink.add(features, labels, "test_data", Db.sessionKey(*row))
+                
+        except SinkFlushError:
+            raise
+        except Exception as ex:
+            print(f"Exception %s: %s"%(row[0], ex))
+            pass
+
+        done += 1
+        if done % 3 == 0:
+            print(f"PAGE {done // 3 - 1} DONE!")
+
+    sink.flush()
+
+# Forked before the AWS client (boto3 and the manifest's SQLite connection) and the database connection
+# are opened and before TensorFlow is imported (modules.db_mlp and modules.mlp), workers inherit none of
+# them. Each worker builds its own AWS client (startWorker).
+workers = ProcessWorkers(initializer=startWorker) if os.getenv("EXECUTION_MODE", "threads") == "processes" else None
+
+aws = AWS()
+
+from modules.db_mlp import Db, FeatureSink, SinkFlushError
+from modules.mlp import MLPEegModel
+
+db = Db()
+sink = FeatureSink(db)
 
 populateTest()
+
+if workers is not None:
+    workers.shutdown()
+
+model = MLPEegModel()
+
+if aws.getCacheStats() is not None:
+    print(f"Cache stats: {aws.getCacheStats()}")
+
+if store is not None:
+    print(f"Feature store stats: {store.stats()}")
+
+print(f"Pool stats: {aws.getPoolStats()}")
+
 y_pred = []
 
 for categorical in model.predict():
@@ -1,61 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import json
+import numpy as np
 import pandas as pd
-import boto3 as aws
 import os
+import tempfile
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
-from modules.edf import EdfParser
+from modules.cache import DiskCache
+from modules.edf import EdfHeader, EdfParser
+from modules.manifest import Manifest
+from modules.storage import LocalStorage, S3Storage
 
 load_dotenv()
 
 class AWS():
     def __init__(self):
         self.bucket = os.getenv("AWS_BUCKET")
-        self.region_name = os.getenv("AWS_REGION")
-        self.aws_access_key_id = os.getenv("AWS_KEY")
-        self.aws_secret_access_key = os.getenv("AWS_SECRET_KEY")
-        self.client = None
-
-    def __getAwsCli(self): 
-
-        if self.client is None: 
-            session = aws.Session(
-                region_name = self.region_name,
-                aws_access_key_id = self.aws_access_key_id,
-                aws_secret_access_key = self.aws_secret_access_key
+        self.cache = None
+        self.spillDir = os.getenv("AWS_SPILL_DIR", tempfile.gettempdir())
+
+        # AWS_BACKEND=local serves the same key layout from a local mirror (AWS_LOCAL_ROOT) instead of S3.
+        if os.getenv("AWS_BACKEND", "s3") == "local":
+            self.storage = LocalStorage(os.getenv("AWS_LOCAL_ROOT"))
+        else:
+            self.storage = S3Storage()
+
+        # Partial EDF downloads, see __downloadPartialEdf
+        self.edfPartial = os.getenv("AWS_EDF_PARTIAL", "0") == "1"
+        self.rangeGap = int(os.getenv("AWS_EDF_RANGE_GAP", 64 * 1024))
+        self.rangeMaxBytes = int(os.getenv("AWS_EDF_RANGE_MAX_MB", 8)) * 1024 * 1024
+        self.rangeWorkers = int(os.getenv("AWS_EDF_RANGE_WORKERS", 8))
+
+        # Opt-in local index of the bucket, see buildManifest
+        self.manifest = Manifest(os.getenv("AWS_MANIFEST")) if os.getenv("AWS_MANIFEST") else None
+
+        # Opt-in local cache, objects are re-downloaded on every run otherwise.
+        if os.getenv("AWS_CACHE_DIR"):
+            self.cache = DiskCache(
+                os.getenv("AWS_CACHE_DIR"),
+                int(os.getenv("AWS_CACHE_MAX_MB", 20480)) * 1024 * 1024
             )
 
-            self.client = session.client('s3')
+    def __missing(self, path: str) -> ClientError:
+        # Same error boto3 raises, so callers handle known-missing objects as before.
+        return ClientError({ "Error": { "Code": "NoSuchKey", "Message": f"{path} not present in manifest" } }, "GetObject")
+
+    def __lookup(self, path: str) -> dict:
+        """ Manifest entry (Size, ETag) for the object, None if its site isn't indexed. Raises ClientError if it's known to be missing. """
+        if self.manifest is None or not self.manifest.covers(path):
+            return None
+
+        entry = self.manifest.get(path)
+        if entry is None:
+            raise self.__missing(path)
+
+        return entry
 
-        return self.client
+    def __resolve(self, candidates: list) -> str:
+        """ First candidate key present in the manifest, None if their site isn't indexed. """
+        if self.manifest is None or not self.manifest.covers(candidates[0]):
+            return None
+
+        for path in candidates:
+            if self.manifest.get(path) is not None:
+                return path
+
+        raise self.__missing(candidates[0])
+
+    def __getEtag(self, path: str) -> str:
+        entry = self.__lookup(path)
+        if entry is not None:
+            return entry["ETag"]
+
+        return self.storage.etag(path)
 
     def __loadAwsFile(self, path: str) -> BytesIO:
-        s3 = self.__getAwsCli()
         file = BytesIO()
-        s3.download_fileobj(self.bucket, path, file)
+
+        if self.cache is None:
+            self.__lookup(path)
+            self.storage.download(path, file)
+        else:
+            etag = self.__getEtag(path)
+            with self.cache.fetch(self.bucket, path, etag, lambda fp: self.storage.download(path, fp)) as cached:
+                file.write(cached.read())
+
         file.seek(0)
 
         return file
 
-    def __listAwsFolder(self, folder: str) -> list:
-        s3 = self.__getAwsCli()
-        result = s3.list_objects_v2(Bucket=self.bucket, Prefix=folder, Delimiter="/")
+    def __downloadAwsFile(self, path: str, dest: str = None) -> str:
+        """
+            Streams the object straight to dest, or to a new spill file if none is given,
+            so big files never have to be held in memory. Returns the written path.
+        """
+        self.__lookup(path)
+
+        if dest is None:
+            fd, dest = tempfile.mkstemp(suffix=os.path.splitext(path)[-1], dir=self.spillDir)
+            os.close(fd)
 
         try:
-            return [item["Prefix"] for item in result["CommonPrefixes"]]
-        except KeyError:
-            return []
+            if self.cache is None:
+                self.storage.downloadFile(path, dest)
+            else:
+                etag = self.__getEtag(path)
+                self.cache.fetch(self.bucket, path, etag, lambda fp: self.storage.download(path, fp), dest)
+        except BaseException:
+            if os.path.exists(dest):
+                os.remove(dest)
+            raise
+
+        return dest
+
+    def __coalesceRanges(self, starts, ends) -> list:
+        # Gaps smaller than rangeGap are cheaper to download than to pay another request for.
+        merged = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if len(merged) > 0 and start - merged[-1][1] <= self.rangeGap and end - merged[-1][0] <= self.rangeMaxBytes:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+
+        return merged
+
+    def __downloadPartialEdf(self, path: str, picks: list, dest: str = None) -> str:
+        """
+            Fetches the EDF header and then only the byte ranges of the picked signals inside
+            each data record, writing them to dest as a valid EDF that holds just those signals.
+        """
+        self.__lookup(path)
+        head, size = self.storage.getRange(path, 0, 256)
+        header = EdfHeader(head + self.storage.getRange(path, 256, EdfHeader.headerSize(head))[0])
+        indices = header.indicesOf(picks)
+
+        if len(indices) == 0:
+            return self.__downloadAwsFile(path, dest)
+
+        records = header.recordCountFor(size)
+        outHeader = header.subset(indices, records)
+
+        # Source and destination offsets of every signal block of every data record.
+        blocks = header.signalRanges(indices)
+        lengths = np.array([end - start for start, end in blocks])
+        outRecordBytes = int(lengths.sum())
+        srcOffsets = np.array([start for start, _ in blocks])
+        dstOffsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        recordIdxs = np.arange(records)[:, None]
+        srcStarts = (header.headerBytes + recordIdxs * header.recordBytes + srcOffsets).ravel()
+        dstStarts = (len(outHeader) + recordIdxs * outRecordBytes + dstOffsets).ravel()
+        srcEnds = srcStarts + np.tile(lengths, records)
+
+        if dest is None:
+            fd, dest = tempfile.mkstemp(suffix=".edf", dir=self.spillDir)
+        else:
+            fd = os.open(dest, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+
+        def fetch(request):
+            start, end = request
+            data, _ = self.storage.getRange(path, start, end)
+
+            first = np.searchsorted(srcEnds, start, side="right")
+            last = np.searchsorted(srcStarts, end, side="left")
+            for block in range(first, last):
+                blockStart = max(srcStarts[block], start)
+                blockEnd = min(srcEnds[block], end)
+                os.pwrite(fd, data[blockStart - start : blockEnd - start], int(dstStarts[block] + blockStart - srcStarts[block]))
+
+        try:
+            os.ftruncate(fd, len(outHeader) + records * outRecordBytes)
+            os.pwrite(fd, outHeader, 0)
+
+            with ThreadPoolExecutor(max_workers=self.rangeWorkers) as executor:
+                list(executor.map(fetch, self.__coalesceRanges(srcStarts, srcEnds)))
+        except BaseException:
+            os.close(fd)
+            os.remove(dest)
+            raise
+
+        os.close(fd)
+
+        return dest
+
+    def __listAwsFolder(self, folder: str) -> list:
+        if self.manifest is not None and self.manifest.covers(folder):
+            return self.manifest.listFolders(folder)
+
+        return [item["Prefix"] for page in self.storage.paginate(folder, "/") for item in page.get("CommonPrefixes", [])]
         
     def __listAwsFiles(self, folder: str) -> list:
-        s3 = self.__getAwsCli()
-        result = s3.list_objects_v2(Bucket=self.bucket, Prefix=folder, Delimiter="/")
+        if self.manifest is not None and self.manifest.covers(folder):
+            return self.manifest.listFiles(folder)
 
-        try:
-            return [item["Key"] for item in result["Contents"]]
-        except KeyError:
-            return []
+        return [item["Key"] for page in self.storage.paginate(folder, "/") for item in page.get("Contents", [])]
+
+    def __buildSiteFolder(self, site) -> str:
+        return f"PSG/bids/{site}/"
     
     def __buildSubFolder(self, sub, site) -> str:
         return f"PSG/bids/{site}/{sub}/"
@@ -92,19 +235,30 @@ class AWS():
         file = self.__loadAwsFile(self.__buildChannelsTsv(sub, session, site))
         return pd.read_csv(file, delimiter="\t")
 
-    def loadEegAnnotationsCsv(self, sub, session, site) -> pd.DataFrame:
+    def __loadFirstAwsFile(self, candidates: list) -> BytesIO:
+        path = self.__resolve(candidates)
+        if path is not None:
+            return self.__loadAwsFile(path)
+
+        # No manifest for this site, discover it by trial and error.
         try:
-            file = self.__loadAwsFile(self.__buildAnnotationsCsv(sub, session, site))
+            return self.__loadAwsFile(candidates[0])
         except ClientError:
-            file = self.__loadAwsFile(self.__buildAnnotationsXltekCsv(sub, session, site))
+            return self.__loadAwsFile(candidates[1])
+
+    def loadEegAnnotationsCsv(self, sub, session, site) -> pd.DataFrame:
+        file = self.__loadFirstAwsFile([
+            self.__buildAnnotationsCsv(sub, session, site),
+            self.__buildAnnotationsXltekCsv(sub, session, site)
+        ])
 
         return pd.read_csv(file)
 
     def loadEegPreSleepQuestCsv(self, sub, session, site) -> pd.DataFrame:
-        try:
-            file = self.__loadAwsFile(self.__buildPreSleepQuestCsv(sub, session, site))
-        except ClientError:
-            file = self.__loadAwsFile(self.__buildPreSleepQuestNoInfoCsv(sub, session, site))
+        file = self.__loadFirstAwsFile([
+            self.__buildPreSleepQuestCsv(sub, session, site),
+            self.__buildPreSleepQuestNoInfoCsv(sub, session, site)
+        ])
 
         return pd.read_csv(file, names=["key", "value"], header=0)
     
@@ -114,6 +268,56 @@ class AWS():
     def getSessionFiles(self, sub, session, site):
         return self.__listAwsFiles(self.__buildSubPrefix(sub, session, site))
 
-    def loadEegEdf(self, sub, session, site) -> EdfParser:
-        file = self.__loadAwsFile(self.__buildEdfFile(sub, session, site))
-        return EdfParser(file)
\ No newline at end of file
+    def buildManifest(self, site) -> int:
+        """ Indexes every object under PSG/bids/<site>/ in the local manifest (AWS_MANIFEST), returns the object count. """
+        if self.manifest is None:
+            raise Exception("AWS_MANIFEST is not configured")
+
+        pages = (page.get("Contents", []) for page in self.storage.paginate(self.__buildSiteFolder(site)))
+        return self.manifest.build(site, pages)
+
+    def getEegEdfSize(self, sub, session, site, default: int = None) -> int:
+        """
+            Size in bytes of the recording, from the manifest if its site is indexed. Otherwise default if
+            given, without any request, or the size a HEAD request reports.
+        """
+        key = self.__buildEdfFile(sub, session, site)
+        entry = self.__lookup(key)
+
+        if entry is not None:
+            return entry["Size"]
+
+        return default if default is not None else self.storage.size(key)
+
+    def getPoolStats(self) -> dict:
+        return self.storage.stats()
+
+    def getCacheStats(self) -> dict:
+        return None if self.cache is None else self.cache.stats()
+
+    def loadEegEdf(self, sub, session, site, path: str = None, picks: list = None, dtype = np.float64) -> EdfParser:
+        """
+            The recording is streamed to disk and handed to EdfParser by path. If path is given
+            the file is kept there after EdfParser.purge, otherwise a managed spill file is used.
+            With picks given only those channels are decoded (and, with AWS_EDF_PARTIAL=1, downloaded).
+            Local backends hand their own file over, it is read in place and never removed.
+        """
+        key = self.__buildEdfFile(sub, session, site)
+
+        if path is None:
+            self.__lookup(key)
+            local = self.storage.localPath(key)
+            if local is not None:
+                return EdfParser(local, ownsFile = False, picks = picks, dtype = dtype)
+
+        if self.edfPartial and picks is not None:
+            file = self.__downloadPartialEdf(key, picks, path)
+        else:
+            file = self.__downloadAwsFile(key, path)
+
+        try:
+            return EdfParser(file, ownsFile = path is None, picks = picks, dtype = dtype)
+        except BaseException:
+            if path is None:
+                os.remove(file)
+            raise
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+class DiskCache():
+    """
+        Persistent content addressed cache for the objects downloaded from the bucket.
+        Entries are keyed by bucket + key + ETag, so a modified object is never served
+        stale, and the least recently used entries are evicted once the configured
+        size budget is exceeded. Safe to share between the ThreadPoolExecutor workers.
+    """
+    def __init__(self, path: str, maxBytes: int):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytesHit = 0
+        self.bytesMissed = 0
+        self.evictions = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.__scan()
+
+    def __scan(self):
+        # Rebuild the LRU order from a previous run, oldest access first.
+        found = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".part"):
+                    os.remove(os.path.join(root, name))
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+
+        for _, digest, size in sorted(found):
+            self.entries[digest] = size
+            self.size += size
+
+        with self.lock:
+            self.__evict()
+
+    def __digest(self, bucket: str, key: str, etag: str) -> str:
+        etag = etag.strip('"')
+        return hashlib.sha256(f"{bucket}\0{key}\0{etag}".encode()).hexdigest()
+
+    def __entryPath(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def __evict(self):
+        while self.size > self.maxBytes and len(self.entries) > 1:
+            digest, size = self.entries.popitem(last=False)
+            try:
+                os.remove(self.__entryPath(digest))
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def __claim(self, digest: str):
+        # Called under the lock so a concurrent eviction can't remove the entry in between, once open it can.
+        return open(self.__entryPath(digest), "rb")
+
+    def __hit(self, digest: str):
+        os.utime(self.__entryPath(digest))
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        self.bytesHit += self.entries[digest]
+
+        return self.__claim(digest)
+
+    def __deliver(self, file, dest: str):
+        if dest is None:
+            return file
+
+        # Copied, never linked: whoever writes dest later would be writing the entry too. dest is removed
+        # first in case it's still a link to an entry (older versions linked them).
+        with file:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            with open(dest, "wb") as out:
+                shutil.copyfileobj(file, out, 1024 * 1024)
+
+        return dest
+
+    def __keyLock(self, digest: str) -> threading.Lock:
+        with self.lock:
+            if digest not in self.pending:
+                self.pending[digest] = threading.Lock()
+            return self.pending[digest]
+
+    def fetch(self, bucket: str, key: str, etag: str, download, dest: str = None):
+        """
+            Returns an open binary file for the given object, calling download(fileobj)
+            to fill the cache on a miss. Concurrent misses on the same object download it once.
+            If dest is given the entry is copied there and dest is returned instead.
+        """
+        digest = self.__digest(bucket, key, etag)
+
+        with self.lock:
+            if digest in self.entries:
+                return self.__deliver(self.__hit(digest), dest)
+
+        lock = self.__keyLock(digest)
+        with lock:
+            try:
+                with self.lock:
+                    if digest in self.entries:
+                        return self.__deliver(self.__hit(digest), dest)
+
+                folder = os.path.dirname(self.__entryPath(digest))
+                os.makedirs(folder, exist_ok=True)
+
+                with tempfile.NamedTemporaryFile(dir=folder, suffix=".part", delete=False) as fp:
+                    try:
+                        download(fp)
+                    except BaseException:
+                        fp.close()
+                        os.remove(fp.name)
+                        raise
+
+                size = os.path.getsize(fp.name)
+                os.replace(fp.name, self.__entryPath(digest))
+
+                with self.lock:
+                    # A reader that got a fresh lock after a failed download may have filled it meanwhile.
+                    self.size += size - self.entries.get(digest, 0)
+                    self.entries[digest] = size
+                    self.misses += 1
+                    self.bytesMissed += size
+                    file = self.__claim(digest)
+                    self.__evict()
+
+                return self.__deliver(file, dest)
+            finally:
+                # Also after a failed download, so the next reader of the key retries it with a fresh lock.
+                with self.lock:
+                    if self.pending.get(digest) is lock:
+                        del self.pending[digest]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytesHit": self.bytesHit,
+                "bytesMissed": self.bytesMissed,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size
+            }
@@ -1,16 +1,63 @@
-from io import StringIO
 import keras
 import numpy as np
 import pandas as pd
 import psycopg2
 import os
+import shutil
+import struct
+import tempfile
 from sklearn.preprocessing import MinMaxScaler
 
 from sklearn.utils import gen_batches, shuffle
 import tensorflow as tf
 
+class StreamReader():
+    """ Read only file object over an iterator of bytes (or buffers), lets a COPY consume data as it's produced. """
+    def __init__(self, parts):
+        self.parts = iter(parts)
+        self.current = memoryview(b"")
+        self.offset = 0
+
+    def read(self, size = -1) -> bytes:
+        while self.offset >= len(self.current):
+            try:
+                self.current = memoryview(next(self.parts)).cast("B")
+                self.offset = 0
+            except StopIteration:
+                return b""
+
+        stop = len(self.current) if size is None or size < 0 else min(self.offset + size, len(self.current))
+        data = bytes(self.current[self.offset:stop])
+        self.offset = stop
+
+        return data
+
 class Db():
 
+    # PGCOPY binary file header, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+    copySignature = b"PGCOPY\n\xff\r\n\x00"
+
+    # Channel order of the chunks given to insertChunks (EdfParser.crop), the one blobs are stored in.
+    storedChannels = ["abd", "c3_m2", "chest", "o1_m2", "ic", "snore", "airflow", "hr", "sao2", "c4_m1", "chin1_chin2", "e1_m2", "e2_m1", "f4_m1", "o1_m1", "ekg", "lat", "rat"]
+
+    # Channel order of the model input, as selected by readChunks.
+    channels = ["abd", "c3_m2", "chest", "o1_m2", "ic", "e1_m2", "snore", "ekg", "airflow", "hr", "lat", "rat", "sao2", "c4_m1", "chin1_chin2", "e2_m1", "f4_m1", "o1_m1"]
+
+    # A row per chunk, its (samples, channels) data in one blob (see encodeChunk). EEG values barely compress
+    # (about 0.86x with zlib), postgres stores it out of line as it is (EXTERNAL) instead of trying to.
+    blobSchema = "".join([f"""
+        CREATE TABLE IF NOT EXISTS public.{table} (
+            chunk_id int4 NOT NULL,
+            samples int4 NOT NULL,
+            channels int2 NOT NULL,
+            data bytea NOT NULL,
+            CONSTRAINT {table}_pk PRIMARY KEY (chunk_id),
+            CONSTRAINT {table}_tags_fk FOREIGN KEY (chunk_id) REFERENCES public.{tags}(chunk_id) ON DELETE CASCADE
+        );
+
+        ALTER TABLE public.{table} ALTER COLUMN data SET STORAGE EXTERNAL;
+    """ for table, tags in [("sample_epochs", "tags"), ("validation_epochs", "validation_tags")]])
+
     def __init__(self):
 
         self.num_classes = 5
@@ -27,6 +74,11 @@ class Db():
             password=self.pwd
         )
 
+        self.datasetCaches = []
+
+        # "rows" stores a row per sample (a float8 column per channel), "blobs" a float32 blob per chunk.
+        self.storage = os.getenv("DB_STORAGE", "rows")
+
         with self.conn.cursor() as cursor:
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS public.tags (
@@ -95,6 +147,9 @@ class Db():
                 );
             """)
 
+            if self.storage == "blobs":
+                cursor.execute(Db.blobSchema)
+
         self.conn.commit()
 
     def reconnect(self):
@@ -140,57 +195,114 @@ class Db():
             return cursor.fetchall()
 
     # https://medium.com/@askintamanli/fastest-methods-to-bulk-insert-a-pandas-dataframe-into-postgresql-2aa2ab6d2b24
-    def __insertChunk(self, chunk: pd.DataFrame, tag: int, chunkId: int, mode = "samples"):
-        chunk = chunk.drop(columns = "time")
-        chunk["chunkid"] = chunkId
-
-        sio = StringIO()
-        chunk.to_csv(sio, index=None, header=None)
-        sio.seek(0)
+    def insertChunks(self, chunks: np.ndarray, tags: list, mode = "samples"):
+        """ chunks as given by EdfParser.crop(asArray = True), (epochs, samples, channels), inserted with a single COPY. """
+        tagsTable = "tags" if mode == "samples" else "validation_tags"
+        maxChunk = self.__getMaxChunk(tagsTable if self.storage == "blobs" else mode)
+        chunkIds = np.arange(maxChunk + 1, maxChunk + 1 + len(chunks))
 
         with self.conn.cursor() as cursor:
-            cursor.execute(f"""
-                INSERT INTO {"tags" if mode == "samples" else "validation_tags"} (tag, chunk_id)
+            cursor.executemany(f"""
+                INSERT INTO {tagsTable} (tag, chunk_id)
                 VALUES (%s, %s);
-            """, 
-            [tag, chunkId])
-
-            cursor.copy_expert(
-                sql = f"""
-                    COPY {mode} (
-                        abd,  
-                        c3_m2,  
-                        chest, 
-                        o1_m2,
-                        ic,
-                        snore,
-                        airflow,
-                        hr,
-                        sao2,
-                        c4_m1,
-                        chin1_chin2,
-                        e1_m2,
-                        e2_m1,
-                        f4_m1,
-                        o1_m1,
-                        ekg,
-                        lat,
-                        rat,
-                        chunk_id
-                    ) FROM STDIN WITH CSV
-                """,
-                file=sio
-            )
+            """,
+            [(int(tag), int(chunkId)) for tag, chunkId in zip(tags, chunkIds)])
+
+            if self.storage == "blobs":
+                cursor.copy_expert(
+                    f"COPY {Db.epochsTable(mode)} (chunk_id, samples, channels, data) FROM STDIN (FORMAT binary)",
+                    StreamReader(Db.blobCopy(chunks, chunkIds))
+                )
+            else:
+                self.__rowsCopy(cursor, chunks, chunkIds, mode)
 
         self.conn.commit()
-        
-    def insertChunks(self, chunks: list, tags: list, mode = "samples"):
-        maxChunk = self.__getMaxChunk(mode)
 
-        offset = 1
-        for chunk, tag in zip(list(map(lambda x: x.to_data_frame(), chunks)), tags):
-            self.__insertChunk(chunk, tag, maxChunk + offset, mode)
-            offset += 1
+    @staticmethod
+    def blobCopy(chunks: np.ndarray, chunkIds: np.ndarray):
+        """ PGCOPY binary rows (chunk_id, samples, channels, data) of the chunks, generated a chunk at a time. """
+        yield Db.copySignature + bytes(8)
+
+        for chunkId, chunk in zip(chunkIds, chunks):
+            blob = Db.encodeChunk(chunk)
+            yield struct.pack(">hiiiiihi", 4, 4, chunkId, 4, chunk.shape[0], 2, chunk.shape[1], len(blob))
+            yield blob
+
+        yield b"\xff\xff"
+
+    def __rowsCopy(self, cursor, chunks: np.ndarray, chunkIds: np.ndarray, mode = "samples"):
+        # A single binary COPY fed a chunk at a time, only the rows of one chunk are encoded at once.
+        dtype = Db.rowsDtype(chunks.shape[2])
+
+        def parts():
+            yield Db.copySignature + bytes(8)
+
+            for chunkId, chunk in zip(chunkIds, chunks):
+                rows = np.empty(chunk.shape[0], dtype=dtype)
+                rows["count"] = chunk.shape[1] + 1
+                for column in range(chunk.shape[1]):
+                    rows[f"length{column}"] = 8
+                    rows[f"value{column}"] = chunk[:, column]
+                rows["idLength"] = 4
+                rows["id"] = chunkId
+
+                yield rows.data
+
+            yield b"\xff\xff"
+
+        columns = ", ".join(Db.storedChannels[:chunks.shape[2]] + ["chunk_id"])
+        cursor.copy_expert(f"COPY {mode} ({columns}) FROM STDIN (FORMAT binary)", StreamReader(parts()))
+
+    @staticmethod
+    def rowsDtype(channels: int) -> np.dtype:
+        """ Layout of a PGCOPY binary row of the samples tables, a float8 per channel and the int4 chunk_id. """
+        fields = [("count", ">i2")]
+        fields += [field for i in range(channels) for field in [(f"length{i}", ">i4"), (f"value{i}", ">f8")]]
+
+        return np.dtype(fields + [("idLength", ">i4"), ("id", ">i4")])
+
+    @staticmethod
+    def epochsTable(mode = "samples") -> str:
+        return "sample_epochs" if mode == "samples" else "validation_epochs"
+
+    @staticmethod
+    def encodeChunk(chunk: np.ndarray) -> bytes:
+        """ (samples, channels) chunk as a little endian float32 blob. """
+        return np.ascontiguousarray(chunk, dtype="<f4").tobytes()
+
+    @staticmethod
+    def decodeChunk(blob: bytes, samples: int, channels: int) -> np.ndarray:
+        """ Inverse of encodeChunk, a read only (samples, channels) view of the blob, checked against the shape stored with it. """
+        values = np.frombuffer(blob, dtype="<f4")
+        if values.size != samples * channels:
+            raise ValueError(f"Blob of {values.size} values stored as ({samples}, {channels})")
+
+        return values.reshape(samples, channels)
+
+    @staticmethod
+    def scaleChunks(chunks: np.ndarray) -> np.ndarray:
+        """ Every channel of every (samples, channels) chunk min-max scaled to [0, 1], as MinMaxScaler per chunk. """
+        chunks = chunks.astype(np.float64)
+        low = chunks.min(axis=1, keepdims=True)
+        span = chunks.max(axis=1, keepdims=True) - low
+        span[span == 0] = 1
+
+        return (chunks - low) / span
+
+    def __readBlobs(self, cursor, batch: list, mode = "samples"):
+        """ (chunks [(samples, channels in storedChannels order)], tags) of the chunk ids in batch, in its order. """
+        cursor.execute(f"""
+            SELECT e.chunk_id, e.samples, e.channels, e.data, t.tag
+            FROM {Db.epochsTable(mode)} AS e JOIN {"tags" if mode == "samples" else "validation_tags"} AS t ON t.chunk_id = e.chunk_id
+            WHERE e.chunk_id IN %s;
+        """,
+        (tuple(int(chunkId) for chunkId in batch),))
+
+        rows = { row[0]: row[1:] for row in cursor.fetchall() }
+        found = [rows[int(chunkId)] for chunkId in batch if int(chunkId) in rows]
+
+        # Every chunk is decoded with its own shape, stacking a batch fails if they differ.
+        return [Db.decodeChunk(data, samples, channels) for samples, channels, data, _ in found], [row[3] for row in found]
 
     def __shuffleChunks(self):
         with self.conn.cursor() as cursor:
@@ -223,6 +335,13 @@ class Db():
 
                     for slice in gen_batches(len(available), batchSize):
                         batch = available[slice]
+
+                        if self.storage == "blobs":
+                            chunks, tags = self.__readBlobs(cursor, batch, mode)
+                            chunks = Db.scaleChunks(np.stack(chunks)[:, :, [Db.storedChannels.index(channel) for channel in Db.channels]])
+
+                            yield tf.constant(chunks), tf.stack(keras.utils.to_categorical(tags, num_classes=self.num_classes)), np.vectorize(lambda x: classWeights[x])(tags)
+                            continue
                         
                         cursor.execute(f"""
                             SELECT abd, c3_m2, chest, o1_m2, ic, e1_m2, snore, ekg, airflow, hr, lat, rat, sao2, c4_m1, chin1_chin2, e2_m1, f4_m1, o1_m1, t.chunk_id, tag 
@@ -308,6 +427,143 @@ class Db():
 
                         yield tf.stack(chunks), tf.stack(keras.utils.to_categorical(tags, num_classes=self.num_classes)), np.vectorize(lambda x: classWeights[x])(tags)
 
+    def __chunkRows(self, tagsTable: str, mode: str, seed: int, blockSize: int, cacheFolder: str = None):
+        """
+            Generator of (chunk, tag), chunk shaped (samples, channels) unscaled, chunks of the mode table in a
+            seeded order, a new one every pass. With cacheFolder the chunks of the first complete pass are kept
+            there (float32, in the order read) and the following passes read them from disk instead of the database.
+        """
+        passes = [0]
+        records = []
+        complete = [False]
+        path = os.path.join(cacheFolder, "chunks") if cacheFolder else None
+
+        def cachedChunks(rng):
+            if len(records) == 0:
+                return
+
+            data = np.memmap(path, dtype=np.float32, mode="r")
+            positions = rng.permutation(len(records)) if mode == "samples" else np.arange(len(records))
+
+            for position in positions:
+                offset, samples, tag = records[position]
+                yield data[offset:offset + samples * len(Db.channels)].reshape(samples, len(Db.channels)), tag
+
+        def tableChunks(rng):
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"SELECT chunk_id, tag FROM {tagsTable} ORDER BY chunk_id;")
+                tags = dict(cursor.fetchall())
+
+                available = np.array(list(tags.keys()), dtype=np.int64)
+                if mode == "samples":
+                    available = rng.permutation(available)
+
+                for slice in gen_batches(len(available), blockSize):
+                    if self.storage == "blobs":
+                        blobs, blobTags = self.__readBlobs(cursor, available[slice], mode)
+                        order = [Db.storedChannels.index(channel) for channel in Db.channels]
+
+                        for chunk, tag in zip(blobs, blobTags):
+                            yield chunk[:, order], tag
+                        continue
+
+                    cursor.execute(f"""
+                        SELECT {", ".join(Db.channels)}, chunk_id FROM {mode} WHERE chunk_id IN %s;
+                    """,
+                    (tuple(available[slice].tolist()),))
+
+                    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, len(Db.channels) + 1)
+
+                    # Stable, rows of a chunk keep the order they were fetched in (as readChunks).
+                    rows = rows[np.argsort(rows[:, -1], kind="stable")]
+                    ids, starts = np.unique(rows[:, -1], return_index=True)
+
+                    for chunkId, start, stop in zip(ids, starts, np.append(starts[1:], len(rows))):
+                        yield rows[start:stop, :-1].astype(np.float32), tags[int(chunkId)]
+
+        def chunks():
+            rng = np.random.default_rng((seed, passes[0]))
+            passes[0] += 1
+
+            if complete[0]:
+                yield from cachedChunks(rng)
+                return
+
+            if path is None:
+                yield from tableChunks(rng)
+                return
+
+            # A pass left halfway (the generator closed) leaves the cache incomplete, the next one writes it again.
+            records.clear()
+            with open(path, "wb") as file:
+                offset = 0
+                for chunk, tag in tableChunks(rng):
+                    chunk = np.ascontiguousarray(chunk, dtype=np.float32)
+                    file.write(chunk.data)
+                    records.append((offset, chunk.shape[0], tag))
+                    offset += chunk.size
+
+                    yield chunk, tag
+
+            complete[0] = True
+
+        return chunks
+
+    def dataset(self, batchSize: int, mode = "samples", seed: int = None, cacheDir: str = None, shuffleBuffer: int = None, blockSize: int = 64):
+        """
+            tf.data version of readChunks (x, y, sample weights) for model.fit, one pass per epoch.
+            Chunks are read blockSize at a time in a seeded (DATASET_SEED) order and min-max scaled
+            per channel in parallel, training batches are drawn from a shuffleBuffer chunks buffer
+            (DATASET_SHUFFLE_BUFFER) and prefetched while the model trains on the previous ones.
+
+            With cacheDir (DATASET_CACHE_DIR) the chunks are cached on local disk during the first epoch
+            and the following ones don't touch the database, they are still drawn in a new seeded order
+            every epoch. clearDatasetCaches() drops the cache files once the model has been fitted.
+        """
+        seed = int(os.getenv("DATASET_SEED", 0)) if seed is None else seed
+        cacheDir = os.getenv("DATASET_CACHE_DIR") if cacheDir is None else cacheDir
+        shuffleBuffer = int(os.getenv("DATASET_SHUFFLE_BUFFER", 512)) if shuffleBuffer is None else shuffleBuffer
+
+        tagsTable = "tags" if mode == "samples" else "validation_tags"
+        classWeights = self.__classWeights(tagsTable)
+        weights = tf.constant([classWeights[label] for label in range(self.num_classes)], dtype=tf.float32)
+
+        def scale(chunk, tag):
+            low = tf.reduce_min(chunk, axis=0, keepdims=True)
+            span = tf.reduce_max(chunk, axis=0, keepdims=True) - low
+
+            # Constant channels are left at 0, as MinMaxScaler does.
+            return (chunk - low) / tf.where(span == 0, tf.ones_like(span), span), tag
+
+        folder = None
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+            folder = tempfile.mkdtemp(prefix=f"{mode}-", dir=cacheDir)
+            self.datasetCaches.append(folder)
+
+        dataset = tf.data.Dataset.from_generator(
+            self.__chunkRows(tagsTable, mode, seed, blockSize, folder),
+            output_signature=(
+                tf.TensorSpec(shape=(None, len(Db.channels)), dtype=tf.float32),
+                tf.TensorSpec(shape=(), dtype=tf.int32)
+            )
+        ).map(scale, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+        if mode == "samples":
+            dataset = dataset.shuffle(max(shuffleBuffer, 1), seed=seed, reshuffle_each_iteration=True)
+
+        return dataset.batch(batchSize).map(
+            lambda x, y: (x, tf.one_hot(y, self.num_classes), tf.gather(weights, y)),
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=True
+        ).prefetch(tf.data.AUTOTUNE)
+
+    def clearDatasetCaches(self):
+        for folder in self.datasetCaches:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        self.datasetCaches = []
+
     def __classWeights(self, mode = "tags"):
         weights = {}
 
@@ -342,6 +598,13 @@ class Db():
 
                     for slice in gen_batches(len(available), batchSize):
                         batch = available[slice]
+
+                        if self.storage == "blobs":
+                            chunks, tags = self.__readBlobs(cursor, batch, mode)
+                            chunks = Db.scaleChunks(np.stack(chunks)[:, :, [Db.storedChannels.index(channel)]])
+
+                            yield tf.constant(chunks), tf.stack(keras.utils.to_categorical(tags, num_classes=self.num_classes)), np.vectorize(lambda x: classWeights[x])(tags)
+                            continue
                         
                         cursor.execute(f"""
                             SELECT {channel}, t.chunk_id, tag 
@@ -1,10 +1,12 @@
 import csv
-from io import StringIO
+from io import BytesIO, StringIO
 import keras
 import numpy as np
 import pandas as pd
 import psycopg2
 import os
+import shutil
+import tempfile
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
 from sklearn.utils import gen_batches, shuffle
@@ -14,12 +16,55 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+class BadCopyFormat(Exception):
+    pass
+
+class SinkFlushError(Exception):
+    pass
+
 class Db():
 
+    featureColumns = [f"{channel}_{band}" for channel in "abcdefg" for band in ["delta", "theta", "alpha", "sigma", "beta"]]
+
+    # PGCOPY binary file header, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+    copySignature = b"PGCOPY\n\xff\r\n\x00"
+
+    # Same tables (samples, validation, test_data) with the features of a row packed in one little endian float32
+    # blob, plus the session (see sessionKey) and the epoch the row comes from. Selected by DB_MLP_SCHEMA=packed
+    # through the connection's search_path, so every query finds them under the same names.
+    packedSchema = "".join([f"""
+        CREATE SCHEMA IF NOT EXISTS packed;
+
+        CREATE TABLE IF NOT EXISTS packed.sessions (
+            id SERIAL PRIMARY KEY,
+            "key" varchar NOT NULL UNIQUE
+        );
+    """] + [f"""
+        CREATE TABLE IF NOT EXISTS packed.{table} (
+            id SERIAL PRIMARY KEY,
+            "session" int4 NOT NULL DEFAULT 0,
+            epoch int4 NOT NULL,
+            features bytea NOT NULL,
+            "label" int4 NOT NULL
+        );
+    """ for table in ["samples", "validation", "test_data"]])
+
     def __init__(self):
 
         self.num_classes = 4
 
+        # "bulk" reads a whole table once per fit with COPY (kept in memory, or in DB_MLP_MEMMAP_DIR), "query" a SELECT per batch.
+        self.loader = os.getenv("DB_MLP_LOADER", "bulk")
+        self.memmapDir = os.getenv("DB_MLP_MEMMAP_DIR")
+        self.datasetCaches = []
+
+        # "binary" inserts with COPY (FORMAT binary) straight from the arrays, "csv" formats every value as text.
+        self.writer = os.getenv("DB_MLP_WRITER", "binary")
+
+        # "columns" keeps a float8 column per feature, "packed" the tables of the packed schema (see packedSchema).
+        self.schema = os.getenv("DB_MLP_SCHEMA", "columns")
+        self.options = "-c search_path=packed,public" if self.schema == "packed" else None
+
         self.db = os.getenv("DB_MLP_NAME")
         self.host = os.getenv("DB_MLP_HOST")
         self.user = os.getenv("DB_MLP_USER")
@@ -29,7 +74,8 @@ class Db():
             host=self.host, 
             database=self.db,
             user=self.user, 
-            password=self.pwd
+            password=self.pwd,
+            options=self.options
         )
 
         with self.conn.cursor() as cursor:
@@ -162,6 +208,9 @@ class Db():
                 );
             """)
 
+            if self.schema == "packed":
+                cursor.execute(Db.packedSchema)
+
         self.conn.commit()
 
     def reconnect(self):
@@ -170,7 +219,8 @@ class Db():
             host=self.host, 
             database=self.db,
             user=self.user, 
-            password=self.pwd
+            password=self.pwd,
+            options=self.options
         )
 
     def flushData(self):
@@ -217,8 +267,60 @@ class Db():
                 page += 1
                 yield cursor.fetchall()
 
+    @staticmethod
+    def sessionKey(folder, session, site) -> str:
+        return f"{site}/{folder}/ses-{session}"
+
+    def __sessionId(self, cursor, key: str) -> int:
+        if key is None:
+            return 0
+
+        cursor.execute("""
+            INSERT INTO sessions ("key") VALUES (%s)
+            ON CONFLICT ("key") DO UPDATE SET "key" = EXCLUDED."key"
+            RETURNING id;
+        """, (key,))
+
+        return cursor.fetchone()[0]
+
+    def insertFeatures(self, features, labels, mode = "samples", commit = True, sessions = None):
+        """
+            Appends the rows (features and their labels) to the table, see FeatureSink to insert several sessions
+            at once. sessions, [(sessionKey, rows)] in the order of the rows, is only kept by the packed schema.
+        """
+        if self.schema == "packed":
+            sessions = [(None, len(features))] if sessions is None else sessions
+
+            with self.conn.cursor() as cursor:
+                ids = [self.__sessionId(cursor, key) for key, _ in sessions]
+                counts = [rows for _, rows in sessions]
+                ints = np.column_stack([
+                    np.asarray(labels).reshape(-1),
+                    np.repeat(ids, counts),
+                    np.concatenate([np.arange(rows) for rows in counts] + [np.zeros(0, dtype=int)])
+                ])
+
+                buffer = BytesIO()
+                Db.writeCopy(buffer, features, ints, True)
+                buffer.seek(0)
+
+                cursor.copy_expert(f'COPY {mode} (features, "label", "session", epoch) FROM STDIN (FORMAT binary)', buffer)
+        elif self.writer == "binary":
+            buffer = BytesIO()
+            Db.writeCopy(buffer, features, labels)
+            buffer.seek(0)
+
+            columns = ", ".join(Db.featureColumns + ['"label"'])
+            with self.conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY {mode} ({columns}) FROM STDIN (FORMAT binary)", buffer)
+        else:
+            self.__insertCsv(features, labels, mode)
+
+        if commit:
+            self.conn.commit()
+
     # https://medium.com/@askintamanli/fastest-methods-to-bulk-insert-a-pandas-dataframe-into-postgresql-2aa2ab6d2b24
-    def insertFeatures(self, features, labels, mode = "samples"):
+    def __insertCsv(self, features, labels, mode = "samples"):
         rows = np.insert(features, features.shape[-1], labels, axis=1).astype(object)
         rows[:, [rows.shape[-1]-1]] = rows[:, [rows.shape[-1]-1]].astype(int)
 
@@ -272,8 +374,6 @@ class Db():
                 file=sio
             )
 
-        self.conn.commit()
-
     def __shuffleChunks(self):
         with self.conn.cursor() as cursor:
             cursor.execute(f"SELECT id FROM samples;")
@@ -308,7 +408,228 @@ class Db():
 
         return weights
 
+    @staticmethod
+    def copyDtype(floats: int, ints: int, packed = False) -> np.dtype:
+        """
+            Layout of a PGCOPY binary tuple of `floats` float8 columns followed by `ints` int4 ones, none NULL.
+            packed: the floats are a single bytea column instead, little endian float32.
+        """
+        fields = [("count", ">i2")]
+        if packed:
+            fields += [("length0", ">i4"), ("value0", "<f4", (floats,))]
+            fields += [field for i in range(1, 1 + ints) for field in [(f"length{i}", ">i4"), (f"value{i}", ">i4")]]
+
+            return np.dtype(fields)
+
+        fields += [field for i in range(floats) for field in [(f"length{i}", ">i4"), (f"value{i}", ">f8")]]
+        fields += [field for i in range(floats, floats + ints) for field in [(f"length{i}", ">i4"), (f"value{i}", ">i4")]]
+
+        return np.dtype(fields)
+
+    @staticmethod
+    def readCopy(file, floats: int, ints: int, spillDir: str = None, packed = False):
+        """
+            (float32 (rows, floats), int64 (rows, ints)) arrays from a COPY ... TO STDOUT (FORMAT binary)
+            output, the floats in a np.memmap file inside spillDir if given. packed: the floats come in a
+            single blob (see copyDtype) and their amount is taken from the first row, floats is only used
+            when there are no rows.
+        """
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+
+        head = file.read(19)
+        if head[:11] != Db.copySignature:
+            raise BadCopyFormat("Not a PGCOPY binary file")
+
+        offset = 19 + int.from_bytes(head[15:19], "big")
+        if packed and size - offset > 2:
+            file.seek(offset + 2)
+            floats = max(int.from_bytes(file.read(4), "big", signed=True), 0) // 4
+
+        dtype = Db.copyDtype(floats, ints, packed)
+        count = (size - offset - 2) // dtype.itemsize
+
+        if isinstance(file, BytesIO):
+            buffer = file.getbuffer()
+            rows = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        else:
+            buffer = None
+            rows = np.memmap(file, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+        columns = 1 + ints if packed else floats + ints
+        if count > 0 and ((rows["count"] != columns).any() or (rows["length0"] != (4 * floats if packed else 8)).any()):
+            raise BadCopyFormat("Unexpected columns, feature counts or NULL values")
+
+        if spillDir is None:
+            features = np.empty((count, floats), dtype=np.float32)
+        else:
+            features = np.memmap(tempfile.TemporaryFile(dir=spillDir), dtype=np.float32, mode="w+", shape=(count, floats))
+
+        for start in range(0, count, 65536):
+            if packed:
+                features[start:start + 65536] = rows["value0"][start:start + 65536]
+                continue
+
+            for column in range(floats):
+                features[start:start + 65536, column] = rows[f"value{column}"][start:start + 65536]
+
+        first = 1 if packed else floats
+        ints = np.array([rows[f"value{column}"] for column in range(first, first + ints)], dtype=np.int64).reshape(ints, count).T
+
+        del rows
+        if buffer is not None:
+            buffer.release()
+
+        return features, ints
+
+    @staticmethod
+    def writeCopy(file, features: np.ndarray, ints: np.ndarray, packed = False):
+        """
+            Writes a PGCOPY binary file with the rows of features (float8 columns, or a float32 blob if packed)
+            followed by ints (int4 columns), inverse of readCopy.
+        """
+        features = np.asarray(features)
+        ints = np.asarray(ints)
+        ints = ints[:, np.newaxis] if ints.ndim == 1 else ints
+        floats = features.shape[-1]
+
+        rows = np.empty(len(features), dtype=Db.copyDtype(floats, ints.shape[-1], packed))
+
+        if packed:
+            rows["count"] = 1 + ints.shape[-1]
+            rows["length0"] = 4 * floats
+            rows["value0"] = features
+            first = 1
+        else:
+            rows["count"] = floats + ints.shape[-1]
+            for column in range(floats):
+                rows[f"length{column}"] = 8
+                rows[f"value{column}"] = features[:, column]
+            first = floats
+
+        for column in range(ints.shape[-1]):
+            rows[f"length{first + column}"] = 4
+            rows[f"value{first + column}"] = ints[:, column]
+
+        # Signature, flags and header extension length, rows and the -1 field count trailer.
+        file.write(Db.copySignature + bytes(8))
+        file.write(rows.data)
+        file.write(b"\xff\xff")
+
+    def loadRows(self, mode = "samples", labels = True, spillDir: str = None):
+        """
+            (features, labels) of a whole table (ordered by id) read with a single binary COPY, labels is None if
+            not asked for. The features are kept in a np.memmap inside spillDir (DB_MLP_MEMMAP_DIR by default) if any.
+        """
+        spillDir = self.memmapDir if spillDir is None else spillDir
+        packed = self.schema == "packed"
+        columns = ", ".join((["features"] if packed else Db.featureColumns) + (['"label"'] if labels else []))
+
+        with (tempfile.TemporaryFile(dir=spillDir) if spillDir else BytesIO()) as raw:
+            with self.conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY (SELECT {columns} FROM {mode} ORDER BY id) TO STDOUT (FORMAT binary)", raw)
+
+            features, ints = Db.readCopy(raw, len(Db.featureColumns), 1 if labels else 0, spillDir, packed)
+
+        return features, ints[:, 0] if labels else None
+
+    @staticmethod
+    def scaleRows(features: np.ndarray) -> np.ndarray:
+        """ Every row min-max scaled to [0, 1] in place, as MinMaxScaler over the transposed rows. """
+        for start in range(0, len(features), 65536):
+            chunk = features[start:start + 65536]
+            low = chunk.min(axis=1, keepdims=True)
+            span = chunk.max(axis=1, keepdims=True) - low
+            span[span == 0] = 1
+            chunk -= low
+            chunk /= span
+
+        return features
+
+    def __bulkChunks(self, batchSize: int, epochs: int, mode = "samples"):
+        features, labels = self.loadRows(mode)
+        Db.scaleRows(features)
+
+        counts = np.bincount(labels, minlength=self.num_classes)
+        weights = (1 - counts / max(len(labels), 1))[labels]
+        categorical = keras.utils.to_categorical(labels, num_classes=self.num_classes)
+
+        for _ in range(epochs):
+            order = shuffle(np.arange(len(labels))) if mode == "samples" else np.arange(len(labels))
+
+            for slice in gen_batches(len(order), batchSize):
+                batch = order[slice]
+                yield tf.constant(features[batch]), tf.constant(categorical[batch]), weights[batch]
+
+    def dataset(self, batchSize: int, mode = "samples", seed: int = None, cacheDir: str = None) -> tf.data.Dataset:
+        """
+            tf.data version of readChunks (x, y, sample weights) for model.fit, one pass per epoch: the
+            table is read once (loadRows) and scaled in place, every epoch a seeded (DATASET_SEED)
+            permutation of the row indices is drawn and its batches gathered from the table in parallel,
+            labels encoded and prefetched. Only the indices are shuffled, the rows are never copied whole.
+
+            With cacheDir (DATASET_CACHE_DIR) the scaled table is kept on local disk (np.memmap) instead
+            of in memory, clearDatasetCaches() drops it once the model has been fitted.
+        """
+        seed = int(os.getenv("DATASET_SEED", 0)) if seed is None else seed
+        cacheDir = os.getenv("DATASET_CACHE_DIR") if cacheDir is None else cacheDir
+
+        spillDir = self.memmapDir
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+            spillDir = tempfile.mkdtemp(prefix=f"{mode}-", dir=cacheDir)
+            self.datasetCaches.append(spillDir)
+
+        features, labels = self.loadRows(mode, spillDir=spillDir)
+        Db.scaleRows(features)
+        labels = labels.astype(np.int32)
+
+        counts = np.bincount(labels, minlength=self.num_classes)
+        weights = tf.constant(1 - counts / max(len(labels), 1), dtype=tf.float32)
+
+        rng = np.random.default_rng(seed)
+
+        def batches():
+            order = rng.permutation(len(labels)) if mode == "samples" else np.arange(len(labels))
+            for slice in gen_batches(len(order), batchSize):
+                yield order[slice]
+
+        def gather(batch):
+            x, y = tf.numpy_function(lambda batch: (features[batch], labels[batch]), [batch], (tf.float32, tf.int32))
+            x.set_shape((None, features.shape[1]))
+            y.set_shape((None,))
+
+            return x, tf.one_hot(y, self.num_classes), tf.gather(weights, y)
+
+        return tf.data.Dataset.from_generator(
+            batches,
+            output_signature=tf.TensorSpec(shape=(None,), dtype=tf.int64)
+        ).map(gather, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True).prefetch(tf.data.AUTOTUNE)
+
+    def clearDatasetCaches(self):
+        for folder in self.datasetCaches:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        self.datasetCaches = []
+
+    def __packedRows(self, cursor, mode: str, ids: list, labels = True) -> pd.DataFrame:
+        """ Rows of the packed schema as the query paths read them, a column per feature (and "label"). """
+        columns = 'features, "label"' if labels else "features"
+        cursor.execute(f"SELECT {columns} FROM {mode} WHERE id IN %s;", (tuple(ids),))
+        rows = cursor.fetchall()
+
+        df = pd.DataFrame(np.array([np.frombuffer(row[0], dtype="<f4") for row in rows]).reshape(len(rows), -1))
+        if labels:
+            df["label"] = [row[1] for row in rows]
+
+        return df
+
     def readChunks(self, batchSize: int, epochs: int, mode = "samples"):
+
+            if self.loader == "bulk":
+                yield from self.__bulkChunks(batchSize, epochs, mode)
+                return
             
             classWeights = self.__classWeights(mode)
             
@@ -324,10 +645,89 @@ class Db():
                     for slice in gen_batches(len(available), batchSize):
                         batch = available[slice]
                         
+                        if self.schema == "packed":
+                            df = self.__packedRows(cursor, mode, batch)
+                        else:
+                            cursor.execute(f"""
+                                SELECT a_delta, a_theta, a_alpha, a_sigma, a_beta, b_delta, b_theta, b_alpha, b_sigma, b_beta, c_delta, c_theta, c_alpha, c_sigma, c_beta, d_delta, d_theta, d_alpha, d_sigma, d_beta,
+                                       e_delta, e_theta, e_alpha, e_sigma, e_beta, f_delta, f_theta, f_alpha, f_sigma, f_beta, g_delta, g_theta, g_alpha, g_sigma, g_beta, "label" 
+                                FROM {mode} AS s
+                                WHERE s.id IN %s;   
+                            """,
+                            (tuple(batch),))
+
+                            df = pd.DataFrame(cursor.fetchall(), columns=[
+                                "a_delta",
+                                "a_theta",
+                                "a_alpha",
+                                "a_sigma",
+                                "a_beta",
+                                "b_delta",
+                                "b_theta",
+                                "b_alpha",
+                                "b_sigma",
+                                "b_beta",
+                                "c_delta",
+                                "c_theta",
+                                "c_alpha",
+                                "c_sigma",
+                                "c_beta",
+                                "d_delta",
+                                "d_theta",
+                                "d_alpha",
+                                "d_sigma",
+                                "d_beta",
+                                "e_delta",
+                                "e_theta",
+                                "e_alpha",
+                                "e_sigma",
+                                "e_beta",
+                                "f_delta",
+                                "f_theta",
+                                "f_alpha",
+                                "f_sigma",
+                                "f_beta",
+                                "g_delta",
+                                "g_theta",
+                                "g_alpha",
+                                "g_sigma",
+                                "g_beta",
+                                "label"
+                            ])
+                        
+                        labels = df["label"]
+                        chunks = df.drop(columns=["label"])
+
+                        # Data is already normalized in featuresPerEvent (modules/edf.py), previously to data insertion.
+                        scaler = MinMaxScaler()
+                        scaled = scaler.fit_transform(chunks.transpose())
+                            
+                        yield tf.stack(scaled.T), tf.stack(keras.utils.to_categorical(labels, num_classes=self.num_classes)), np.vectorize(lambda x: classWeights[x])(labels)
+
+    def predictChunks(self, batchSize: int):
+
+            if self.loader == "bulk":
+                features, _ = self.loadRows("test_data", False)
+                Db.scaleRows(features)
+
+                for slice in gen_batches(len(features), batchSize):
+                    yield tf.constant(features[slice]),
+                return
+            
+            with self.conn.cursor() as cursor:
+            
+                available = self.__validationChunks("test_data")
+
+                for slice in gen_batches(len(available), batchSize):
+                    batch = available[slice]
+                    
+                    if self.schema == "packed":
+                        df = self.__packedRows(cursor, "test_data", batch, False)
+                    else:
                         cursor.execute(f"""
                             SELECT a_delta, a_theta, a_alpha, a_sigma, a_beta, b_delta, b_theta, b_alpha, b_sigma, b_beta, c_delta, c_theta, c_alpha, c_sigma, c_beta, d_delta, d_theta, d_alpha, d_sigma, d_beta,
-                                   e_delta, e_theta, e_alpha, e_sigma, e_beta, f_delta, f_theta, f_alpha, f_sigma, f_beta, g_delta, g_theta, g_alpha, g_sigma, g_beta, "label" 
-                            FROM {mode} AS s
+                                    e_delta, e_theta, e_alpha, e_sigma, e_beta, f_delta, f_theta, f_alpha, f_sigma, f_beta, g_delta, g_theta, g_alpha, g_sigma, g_beta 
+                            FROM test_data AS s
                             WHERE s.id IN %s;   
                         """,
                         (tuple(batch),))
@@ -367,73 +767,8 @@ class Db():
                             "g_theta",
                             "g_alpha",
                             "g_sigma",
-                            "g_beta",
-                            "label"
+                            "g_beta"
                         ])
-                        
-                        labels = df["label"]
-                        chunks = df.drop(columns=["label"])
-
-                        # Data is already normalized in featuresPerEvent (modules/edf.py), previously to data insertion.
-                        scaler = MinMaxScaler()
-                        scaled = scaler.fit_transform(chunks.transpose())
-                            
-                        yield tf.stack(scaled.T), tf.stack(keras.utils.to_categorical(labels, num_classes=self.num_classes)), np.vectorize(lambda x: classWeights[x])(labels)
-
-    def predictChunks(self, batchSize: int):
-            
-            with self.conn.cursor() as cursor:
-            
-                available = self.__validationChunks("test_data")
-
-                for slice in gen_batches(len(available), batchSize):
-                    batch = available[slice]
-                    
-                    cursor.execute(f"""
-                        SELECT a_delta, a_theta, a_alpha, a_sigma, a_beta, b_delta, b_theta, b_alpha, b_sigma, b_beta, c_delta, c_theta, c_alpha, c_sigma, c_beta, d_delta, d_theta, d_alpha, d_sigma, d_beta,
-                                e_delta, e_theta, e_alpha, e_sigma, e_beta, f_delta, f_theta, f_alpha, f_sigma, f_beta, g_delta, g_theta, g_alpha, g_sigma, g_beta 
-                        FROM test_data AS s
-                        WHERE s.id IN %s;   
-                    """,
-                    (tuple(batch),))
-
-                    df = pd.DataFrame(cursor.fetchall(), columns=[
-                        "a_delta",
-                        "a_theta",
-                        "a_alpha",
-                        "a_sigma",
-                        "a_beta",
-                        "b_delta",
-                        "b_theta",
-                        "b_alpha",
-                        "b_sigma",
-                        "b_beta",
-                        "c_delta",
-                        "c_theta",
-                        "c_alpha",
-                        "c_sigma",
-                        "c_beta",
-                        "d_delta",
-                        "d_theta",
-                        "d_alpha",
-                        "d_sigma",
-                        "d_beta",
-                        "e_delta",
-                        "e_theta",
-                        "e_alpha",
-                        "e_sigma",
-                        "e_beta",
-                        "f_delta",
-                        "f_theta",
-                        "f_alpha",
-                        "f_sigma",
-                        "f_beta",
-                        "g_delta",
-                        "g_theta",
-                        "g_alpha",
-                        "g_sigma",
-                        "g_beta"
-                    ])
 
                     # Data is already normalized in featuresPerEvent (modules/edf.py), previously to data insertion.
                     scaler = MinMaxScaler()
@@ -460,3 +795,48 @@ class Db():
         self.conn.close()
                     
 
+class FeatureSink():
+    """
+        Buffers the features of several sessions and inserts them with one COPY per table in a single
+        transaction, once `sessions` sessions (DB_MLP_SINK_SESSIONS) or `rows` rows (DB_MLP_SINK_ROWS)
+        are waiting. Nothing added is in the database until flush(): flush before reading the tables
+        and before checkpointing the sessions added (see pending). A failed flush (SinkFlushError, from
+        add() too) keeps the sessions buffered, they are still pending.
+    """
+    def __init__(self, db: Db, sessions: int = None, rows: int = None):
+        self.db = db
+        self.sessions = int(os.getenv("DB_MLP_SINK_SESSIONS", 8)) if sessions is None else sessions
+        self.rows = int(os.getenv("DB_MLP_SINK_ROWS", 65536)) if rows is None else rows
+
+        self.buffers = {}
+        self.pending = 0
+        self.pendingRows = 0
+
+    def add(self, features, labels, mode = "samples", session: str = None):
+        """ session: the session key (Db.sessionKey) of the rows, kept by the packed schema. """
+        self.buffers.setdefault(mode, []).append((features, labels, session))
+        self.pending += 1
+        self.pendingRows += len(features)
+
+        if self.pending >= self.sessions or self.pendingRows >= self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+
+        try:
+            for mode, buffered in self.buffers.items():
+                features = np.concatenate([features for features, _, _ in buffered])
+                labels = np.concatenate([np.asarray(labels).reshape(-1) for _, labels, _ in buffered])
+                sessions = [(session, len(features)) for features, _, session in buffered]
+                self.db.insertFeatures(features, labels, mode, False, sessions)
+
+            self.db.conn.commit()
+        except Exception as ex:
+            self.db.conn.rollback()
+            raise SinkFlushError(f"{self.pending} sessions ({self.pendingRows} rows) not inserted: {ex}") from ex
+
+        self.buffers = {}
+        self.pending = 0
+        self.pendingRows = 0
@@ -1,118 +1,594 @@
+from concurrent.futures import Future
+from datetime import datetime, timezone
 from io import BytesIO
 from warnings import warn
 import mne
 import numpy as np
 import pandas as pd
-import tempfile
 import os
+import threading
+from scipy.signal import resample
 from sklearn.preprocessing import MinMaxScaler, StandardScaler
+from modules.spectral import SpectralEngine
 
 class BadSamplingFreq(Exception):
     pass
 
+class NoEvents(Exception):
+    pass
+
+class RepeatedEvents(Exception):
+    pass
+
+class EdfHeader():
+    """
+        Parsed EDF/EDF+ header (https://www.edfplus.info/specs/edf.html), channel names follow
+        mne's read_raw_edf(infer_types=True) so they can be matched against ChannSelector picks.
+    """
+    # Per signal fields, in file order, with their width in bytes.
+    signalFields = [
+        ("labels", 16),
+        ("transducers", 80),
+        ("units", 8),
+        ("physicalMin", 8),
+        ("physicalMax", 8),
+        ("digitalMin", 8),
+        ("digitalMax", 8),
+        ("prefilters", 80),
+        ("samples", 8),
+        ("reserved", 32)
+    ]
+
+    # Same prefixes mne recognises as channel types when infer_types=True.
+    channelTypes = ["EEG", "SEEG", "ECOG", "DBS", "EOG", "ECG", "EMG", "BIO", "RESP", "TEMP", "MISC", "SAO2", "STIM"]
+    annotationLabels = ["EDF Annotations", "BDF Annotations"]
+
+    def __init__(self, raw: bytes):
+        self.raw = raw[:EdfHeader.headerSize(raw)]
+        self.headerBytes = len(self.raw)
+        self.recordCount = int(self.__field(236, 8))
+        self.recordDuration = float(self.__field(244, 8)) or 1.0
+        self.signalCount = int(self.__field(252, 4))
+
+        self.fields = {}
+        offset = 256
+        for name, width in EdfHeader.signalFields:
+            self.fields[name] = [self.raw[offset + i * width : offset + (i + 1) * width] for i in range(self.signalCount)]
+            offset += width * self.signalCount
+
+        self.labels = [label.strip().decode("latin-1") for label in self.fields["labels"]]
+        self.samples = np.array([int(self.__text(field)) for field in self.fields["samples"]])
+        self.annotations = np.isin(self.labels, EdfHeader.annotationLabels)
+        self.names, self.types = self.__inferTypes()
+
+        # Byte offsets of every signal inside a data record.
+        self.offsets = np.concatenate([[0], np.cumsum(self.samples * 2)])
+        self.recordBytes = int(self.offsets[-1])
+
+    @staticmethod
+    def headerSize(raw: bytes) -> int:
+        return int(raw[184:192].decode("latin-1").split("\x00")[0])
+
+    def __text(self, field: bytes) -> str:
+        return field.decode("latin-1").split("\x00")[0].strip()
+
+    def __field(self, offset: int, width: int) -> str:
+        return self.__text(self.raw[offset : offset + width])
+
+    def __inferTypes(self):
+        names, types = [], []
+        for label in self.labels:
+            parts = label.split(" ")
+            if len(parts) > 1 and parts[0].upper() in EdfHeader.channelTypes:
+                types.append(parts[0].upper())
+                names.append(" ".join(parts[1:]))
+            else:
+                types.append("EEG")
+                names.append(label)
+
+        # Duplicated names get running numbers, as mne does, annotation signals aside.
+        signals = [i for i in range(self.signalCount) if not self.annotations[i]]
+        for name in set(names[i] for i in signals):
+            duplicates = [i for i in signals if names[i] == name]
+            if len(duplicates) > 1:
+                taken = set(names[i] for i in signals)
+                for idx, i in enumerate(duplicates):
+                    for suffix in [idx] + list("abcdefghijklmnopqrstuvwxyz"):
+                        candidate = f"{name}-{suffix}"
+                        if candidate not in taken:
+                            break
+                    if candidate not in taken:
+                        names[i] = candidate
+                        taken.add(candidate)
+
+        return names, types
+
+    def indicesOf(self, picks: list) -> list:
+        """ Indices of the given channel names in file order, unknown names are ignored. """
+        return [i for i, name in enumerate(self.names) if name in picks and not self.annotations[i]]
+
+    def recordCountFor(self, fileSize: int) -> int:
+        # The header count may be -1 or stale if the recording wasn't stopped properly.
+        return (fileSize - self.headerBytes) // self.recordBytes
+
+    def signalRanges(self, indices: list) -> list:
+        """ Byte ranges, relative to a data record, covering the given signals. Adjacent signals are merged. """
+        ranges = []
+        for i in sorted(indices):
+            start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+
+        return ranges
+
+    def subset(self, indices: list, recordCount: int) -> bytes:
+        """ Header of an EDF holding only the given signals (in file order) and recordCount data records. """
+        indices = sorted(indices)
+        headerBytes = 256 * (len(indices) + 1)
+
+        raw = bytearray(self.raw[:256])
+        raw[184:192] = str(headerBytes).ljust(8).encode("latin-1")
+        raw[236:244] = str(recordCount).ljust(8).encode("latin-1")
+        raw[252:256] = str(len(indices)).ljust(4).encode("latin-1")
+
+        for name, _ in EdfHeader.signalFields:
+            for i in indices:
+                raw += self.fields[name][i]
+
+        return bytes(raw)
+
+
+class EdfReader():
+    """
+        Native EDF/EDF+ reader, opening a recording only parses its header: the data records are exposed
+        as a (records, samples per record) int16 view, memory mapped for files on disk or laid over
+        the buffer for in memory files, and signals are scaled to physical units (V) when read.
+        Values match mne's read_raw_edf (https://github.com/mne-tools/mne-python/blob/main/mne/io/edf/edf.py).
+    """
+    unitScales = { "uV": 1e-6, "\u00b5V": 1e-6, "\u03bcV": 1e-6, "\x83\xcaV": 1e-6, "mV": 1e-3 }
+
+    # infer_types names as understood by mne.create_info
+    mneTypes = { "TEMP": "temperature", "SAO2": "bio" }
+
+    # Raw.to_data_frame() default scalings (V to µV), types not listed are left as they are.
+    dataFrameScalings = { "eeg": 1e6, "ecog": 1e6, "dbs": 1e6, "eog": 1e6, "ecg": 1e6, "emg": 1e6, "bio": 1e6, "seeg": 1e3 }
+
+    def __init__(self, source: str | BytesIO | bytes):
+        if isinstance(source, str):
+            with open(source, "rb") as fp:
+                raw = fp.read(256)
+                raw += fp.read(EdfHeader.headerSize(raw) - 256)
+
+            self.header = EdfHeader(raw)
+            self.recordCount = self.header.recordCountFor(os.path.getsize(source))
+            self.records = np.memmap(source, dtype="<i2", mode="r", offset=self.header.headerBytes, shape=(self.recordCount, self.header.recordBytes // 2))
+        else:
+            buffer = source.getbuffer() if isinstance(source, BytesIO) else memoryview(source)
+
+            self.header = EdfHeader(bytes(buffer[:EdfHeader.headerSize(bytes(buffer[:256]))]))
+            self.recordCount = self.header.recordCountFor(len(buffer))
+            self.records = np.frombuffer(buffer, dtype="<i2", count=self.recordCount * self.header.recordBytes // 2, offset=self.header.headerBytes)
+            self.records = self.records.reshape(self.recordCount, self.header.recordBytes // 2)
+
+        header = self.header
+        self.signals = [i for i in range(header.signalCount) if not header.annotations[i]]
+        self.sfreq = float(header.samples[self.signals].max() / header.recordDuration)
+        self.nTimes = int(self.recordCount * header.samples[self.signals].max())
+        self.duration = self.nTimes / self.sfreq
+        self.measDate = self.__measDate()
+
+        # physical = (digital * cal + offset) * unit, computed as mne does.
+        physicalMin = np.array([float(self.__text(field)) for field in header.fields["physicalMin"]])
+        physicalMax = np.array([float(self.__text(field)) for field in header.fields["physicalMax"]])
+        digitalMin = np.array([float(self.__text(field)) for field in header.fields["digitalMin"]])
+        digitalMax = np.array([float(self.__text(field)) for field in header.fields["digitalMax"]])
+
+        physicalRange = physicalMax - physicalMin
+        digitalRange = digitalMax - digitalMin
+        physicalRange[physicalRange == 0] = 1
+        digitalRange[(digitalRange == 0) | ~np.isfinite(digitalRange)] = 1
+
+        self.cal = physicalRange / digitalRange
+        self.offsets = physicalMin - digitalMin * self.cal
+        self.units = np.array([EdfReader.unitScales.get(self.__text(field, False), 1.0) for field in header.fields["units"]])
+
+        stim = np.array(header.types) == "STIM"
+        self.cal[stim], self.offsets[stim], self.units[stim] = 1, 0, 1
+
+    def __text(self, field: bytes, strip = True) -> str:
+        text = field.decode("latin-1").split("\x00")[0]
+        return text.strip() if strip else text.rstrip()
+
+    def __measDate(self) -> datetime:
+        raw = self.header.raw
+        recording = raw[88:168].decode("latin-1").rstrip().split(" ")
+
+        date = None
+        # EDF+ recording field holds the four digits year, "Startdate dd-MMM-yyyy ..."
+        if len(recording) == 5:
+            try:
+                date = datetime.strptime(recording[1], "%d-%b-%Y")
+            except ValueError:
+                date = None
+
+        try:
+            if date is None:
+                day, month, year = (int(x) for x in raw[168:176].decode("latin-1").split("."))
+                date = datetime(year + 2000 if year < 85 else year + 1900, month, day)
+        except ValueError:
+            return None
+
+        try:
+            hour, minute, second = (int(x) for x in raw[176:184].decode("latin-1").split("."))
+        except ValueError:
+            hour, minute, second = 0, 0, 0
+
+        return date.replace(hour=hour, minute=minute, second=second, tzinfo=timezone.utc)
+
+    @property
+    def names(self) -> list:
+        return [self.header.names[i] for i in self.signals]
+
+    @property
+    def types(self) -> list:
+        return [EdfReader.mneTypes.get(self.header.types[i], self.header.types[i].lower()) for i in self.signals]
+
+    def indicesOf(self, picks: list) -> list:
+        return self.header.indicesOf(picks)
+
+    def digital(self, index: int) -> np.ndarray:
+        """ Zero copy (records, samples per record) view of the raw values of a signal. """
+        start, end = self.header.offsets[index] // 2, self.header.offsets[index + 1] // 2
+        return self.records[:, start:end]
+
+    def signal(self, index: int, dtype = np.float64) -> np.ndarray:
+        """ Physical values of a signal at the global sampling frequency. """
+        data = self.digital(index).astype(dtype)
+        data *= self.cal[index]
+        data += self.offsets[index]
+        data *= self.units[index]
+        data = data.ravel()
+
+        # Lower rate signals are upsampled over the whole recording, as mne does with preload=True.
+        if data.shape[-1] != self.nTimes:
+            data = resample(data, self.nTimes)
+
+        return data.astype(dtype, copy=False)
+
+    def isFullRate(self, index: int) -> bool:
+        return self.header.samples[index] * self.recordCount == self.nTimes
+
+    def signalRange(self, index: int, start: int, stop: int, dtype = np.float64) -> np.ndarray:
+        """ Samples [start, stop) of a signal, only the records holding them are read. Full rate signals only. """
+        perRecord = int(self.header.samples[index])
+        first, last = start // perRecord, -(-stop // perRecord)
+
+        data = self.digital(index)[first:last].astype(dtype).ravel()[start - first * perRecord : stop - first * perRecord]
+        data *= self.cal[index]
+        data += self.offsets[index]
+        data *= self.units[index]
+
+        return data
+
+    def readSignals(self, indices: list = None, dtype = np.float64) -> np.ndarray:
+        """ (channels, samples) array with the given signals, all of them but the annotations by default. """
+        indices = self.signals if indices is None else indices
+        data = np.empty((len(indices), self.nTimes), dtype=dtype)
+        for row, index in enumerate(indices):
+            data[row] = self.signal(index, dtype)
+
+        return data
+
+    def toRaw(self, indices: list = None, data: np.ndarray = None, sfreq: float = None) -> mne.io.RawArray:
+        """
+            mne Raw with the given signals, for the code paths that still rely on mne. Already decoded
+            signals may be passed, at another sampling frequency if they were resampled.
+        """
+        indices = self.signals if indices is None else indices
+        positions = [self.signals.index(i) for i in indices]
+
+        info = mne.create_info([self.names[i] for i in positions], self.sfreq if sfreq is None else sfreq, [self.types[i] for i in positions])
+        raw = mne.io.RawArray(self.readSignals(indices) if data is None else data, info, verbose="error")
+        raw.set_meas_date(self.measDate)
+
+        return raw
+
+    def close(self):
+        self.records = None
+
+class AnnotationCompiler():
+    """
+        Turns the annotation files (time, event, duration) into the onsets (seconds from the start
+        of the recording), durations, tags and labels of the sleep stage events. Events are mapped
+        to their tag and label through a table built once from annotationsTags/tagsToClass, so one
+        compiler serves every session with the same tags.
+    """
+    def __init__(self, annotationsTags: dict, tagsToClass: dict, stopEvent: str):
+        self.annotationsTags = annotationsTags
+        self.tagsToClass = tagsToClass
+        self.stopEvent = stopEvent
+
+        # Candidates are replaced tag by tag, a tag may itself be a candidate of a later one.
+        table = { tag: tag for tag in annotationsTags }
+        for tag, candidates in annotationsTags.items():
+            for event, mapped in table.items():
+                if mapped in candidates:
+                    table[event] = tag
+            for candidate in candidates:
+                table[candidate] = tag
+
+        self.tags = list(annotationsTags)
+        self.codes = { event: self.tags.index(tag) for event, tag in table.items() }
+        self.labels = np.array([tagsToClass.get(tag, -1) for tag in self.tags], dtype=int)
+
+    @staticmethod
+    def secondsOfDay(times: pd.Series):
+        """ (seconds, hours) of "HH:MM:SS" times, parsed from their bytes unless some doesn't follow the format. """
+        values = times.to_numpy()
+
+        try:
+            chars = values.astype("S9").view(np.uint8).reshape(-1, 9)
+        except (UnicodeEncodeError, ValueError):
+            chars = None
+
+        if chars is not None:
+            digits = chars[:, [0, 1, 3, 4, 6, 7]].astype(int) - ord("0")
+            hours = digits[:, 0] * 10 + digits[:, 1]
+            minutes = digits[:, 2] * 10 + digits[:, 3]
+            seconds = digits[:, 4] * 10 + digits[:, 5]
+
+            if ((chars[:, [2, 5]] == ord(":")).all() and (chars[:, 8] == 0).all() and ((digits >= 0) & (digits <= 9)).all()
+                and (hours < 24).all() and (minutes < 60).all() and (seconds < 60).all()):
+                return (hours * 3600 + minutes * 60 + seconds).astype(float), hours
+
+        parsed = pd.to_datetime(times, format="%H:%M:%S")
+        return (parsed.dt.hour * 3600 + parsed.dt.minute * 60 + parsed.dt.second).to_numpy(dtype=float), parsed.dt.hour.to_numpy()
+
+    def codesOf(self, events) -> np.ndarray:
+        """ Position in self.tags of every event, -1 for the ones that aren't sleep stages. """
+        return pd.Series(events, dtype=object).map(self.codes).fillna(-1).to_numpy(dtype=int)
+
+    def compile(self, rawAnnotations: pd.DataFrame, measDate: datetime, duration: float):
+        """
+            (onsets, durations, tags, labels) of the sleep stage events before the stop event (if
+            there's a single one) and before the first annotation ending past the recording.
+        """
+        seconds, hours = AnnotationCompiler.secondsOfDay(rawAnnotations["time"])
+
+        # Add a day past twelve
+        start = measDate.hour * 3600 + measDate.minute * 60 + measDate.second + measDate.microsecond / 1e6
+        onsets = seconds + 86400.0 * (hours < measDate.hour) - start
+
+        events = rawAnnotations["event"].to_numpy()
+        durations = rawAnnotations["duration"].to_numpy(dtype=float)
+        codes = self.codesOf(events)
+
+        stops = np.flatnonzero(events == self.stopEvent)
+        stopIndex = stops[0] if len(stops) == 1 else len(events)
+
+        # Add one second offset trying to avoid truncation errors in crop()
+        beyond = np.flatnonzero(onsets + durations + 1 > duration)
+        if len(beyond) > 0:
+            stopIndex = min(stopIndex, beyond[0])
+
+        # Discard events that are out of file boundaries
+        selected = np.flatnonzero(codes[:stopIndex] >= 0)
+        codes = codes[selected]
+
+        return onsets[selected], durations[selected], np.array(self.tags, dtype=object)[codes], self.labels[codes]
+
+class FeatureBatcher():
+    """
+        Gathers the epochs of the sessions computed at the same time by different threads and runs
+        their PSDs together (EdfParser.batchFeatures). A thread waits at most `wait` seconds for
+        the batch of `sessions` to fill, then computes whatever has been gathered.
+    """
+    def __init__(self, sessions: int = None, wait: float = None):
+        self.sessions = int(os.getenv("EDF_PSD_BATCH_SESSIONS", 4)) if sessions is None else sessions
+        self.wait = int(os.getenv("EDF_PSD_BATCH_WAIT_MS", 200)) / 1000 if wait is None else wait
+        self.spectral = SpectralEngine()
+        self.condition = threading.Condition()
+        self.pending = []
+
+    def __compute(self, batch: list):
+        try:
+            results = EdfParser.batchFeatures([prepared for _, prepared in batch], self.spectral)
+        except Exception as ex:
+            for future, _ in batch:
+                future.set_exception(ex)
+            return
+
+        for (future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def features(self, epochData: np.ndarray, sfreq: float, labels: np.ndarray):
+        """ (features, labels) of one session, as featuresPerEvent, computed along with the others pending. """
+        future = Future()
+        batch = None
+
+        with self.condition:
+            self.pending.append((future, (epochData, sfreq, labels)))
+            queued = lambda: any(pending is future for pending, _ in self.pending)
+
+            if len(self.pending) < self.sessions:
+                self.condition.wait_for(lambda: not queued(), self.wait)
+
+            # Nobody took this session in time (or the batch is full), compute what's pending here.
+            if queued():
+                batch, self.pending = self.pending, []
+                self.condition.notify_all()
+
+        if batch is not None:
+            self.__compute(batch)
+
+        return future.result()
+
 class EdfParser:
+    stopEvent = "Stopped_Analyzer_-_Sleep_Events"
+    annotationsTags = { 
+        "Sleep_stage_W" : ["Sleep_stage_4" ,"Sleep_stage_W"],  
+        "Sleep_stage_N2": ["Sleep_stage_N2", "Sleep_stage_2", "Sleep_stage_1", "Sleep_stage_N1"], 
+        "Sleep_stage_N3": ["Sleep_stage_N3", "Sleep_stage_3"], 
+        "Sleep_stage_R": ["Sleep_stage_REM", "Sleep_stage_R"] 
+    }
+    tagsToClass = { 
+        "Sleep_stage_W" : 1, 
+        "Sleep_stage_N2": 2, 
+        "Sleep_stage_N3": 3, 
+        "Sleep_stage_R": 0 
+    }
+
+    freqBands = {
+        "delta": [0.5, 4.5],
+        "theta": [4.5, 8.5],
+        "alpha": [8.5, 11.5],
+        "sigma": [11.5, 15.5],
+        "beta": [15.5, 30],
+    }
+
+    fmin = 0.5
+    fmax = 30.0
+    epochDuration = 30.0
+
+    # Bump when featuresPerEvent changes in a way the settings in featuresVersion() don't capture.
+    featuresRevision = 1
+
+    compiler = None
 
-    def __init__(self, file: BytesIO):
+    def __init__(self, file: BytesIO | str, ownsFile = True, picks: list = None, dtype = np.float64):
+        """
+            With picks given only those channels are decoded (in file order), the rest of the signals
+            are never read from the file. dtype is the one of getData(), mne's Raw is always float64.
+        """
         mne.set_log_level(verbose="CRITICAL")
         self.annotations = None
-        self.picks = None
-        self.stopEvent = "Stopped_Analyzer_-_Sleep_Events"
-        self.annotationsTags = { 
-            "Sleep_stage_W" : ["Sleep_stage_4" ,"Sleep_stage_W"],  
-            "Sleep_stage_N2": ["Sleep_stage_N2", "Sleep_stage_2", "Sleep_stage_1", "Sleep_stage_N1"], 
-            "Sleep_stage_N3": ["Sleep_stage_N3", "Sleep_stage_3"], 
-            "Sleep_stage_R": ["Sleep_stage_REM", "Sleep_stage_R"] 
-        }
-        self.tagsToClass = { 
-            "Sleep_stage_W" : 1, 
-            "Sleep_stage_N2": 2, 
-            "Sleep_stage_N3": 3, 
-            "Sleep_stage_R": 0 
-        }
+        self.picks = picks
+        self.dtype = dtype
 
-        self.freqBands = {
-            "delta": [0.5, 4.5],
-            "theta": [4.5, 8.5],
-            "alpha": [8.5, 11.5],
-            "sigma": [11.5, 15.5],
-            "beta": [15.5, 30],
-        }
+        # Files already on disk (see AWS.loadEegEdf) are memory mapped in place, purge() only removes them if owned.
+        if isinstance(file, str):
+            self.filename = file
+            self.ownsFile = ownsFile
+        else:
+            self.filename = None
+            self.ownsFile = False
 
-        # https://github.com/mne-tools/mne-python/pull/13156
-        with tempfile.NamedTemporaryFile(suffix='.edf', delete_on_close=False, delete=False) as fp:
-            fp.write(file.getbuffer())
-            fp.seek(0)
-            self.filename = fp.name
-            self.edf = mne.io.read_raw_edf(fp.name, preload=True, infer_types=True, verbose="error")
-            if self.edf.info["sfreq"] != 200.0:
-                warn(f"Bad sampling frequency: {self.edf.info["sfreq"]}")
-                #raise BadSamplingFreq(self.edf.info["sfreq"])
-            # self.df = pd.DataFrame(self.edf.get_data().transpose(), columns=self.edf.ch_names)
+        self.spectral = SpectralEngine()
+        self.targetSfreq = EdfParser.sfreqTarget()
+        self.analysisSfreq = EdfParser.analysisTarget()
+        self.analysis = None
 
-    def getChannelTypes(self):
-        return self.edf.get_channel_types()
-    
-    def __selectAnnotations(self, rawAnnotations: pd.DataFrame):
-        measDate = self.edf.info['meas_date']
-        measDay = measDate.strftime("%Y-%m-%d")
-        
-        times = rawAnnotations['time'].copy()
-        times = measDay + " " + times
-        times = pd.to_datetime(times, format='%Y-%m-%d %H:%M:%S', utc=True)
-        
-        # Add a day past twelve
-        times[times.dt.hour < measDate.hour] = times[times.dt.hour < measDate.hour] + pd.Timedelta(days = 1)
-        times = (times - measDate) / pd.Timedelta(seconds=1)
-        
-        events = rawAnnotations['event'].copy()
-        aggregated = []
+        # "numpy" epochs views of the signals, "mne" goes through mne.Epochs (slower, kept as reference).
+        self.epoching = os.getenv("EDF_EPOCHING", "numpy")
 
-        for tag, candidates in self.annotationsTags.items():
-            events.loc[events.isin(candidates)] = tag
-            aggregated.append(tag)
-        
-        eventsIdxs = events.index[events.isin(aggregated)].tolist()
+        self.reader = EdfReader(file)
+        self.indices = self.reader.signals if picks is None else self.reader.indicesOf(picks)
+        self.names = [self.reader.header.names[i] for i in self.indices]
+        self.data = None
+        self.raw = None
 
-        idxs = rawAnnotations.index[rawAnnotations['event'] == self.stopEvent].tolist()
+        # Rate of getData(), recordings at another rate are resampled to targetSfreq once decoded.
+        self.sfreq = self.reader.sfreq
+        if self.targetSfreq:
+            up, down = SpectralEngine.resamplingRatio(self.reader.sfreq, self.targetSfreq)
+            self.sfreq = self.reader.sfreq * up / down
 
-        if len(idxs) == 1:
-            stopIndex = idxs[0]
-        else:
-            stopIndex = rawAnnotations['event'].shape[0]
+        if self.sfreq != 200.0:
+            warn(f"Bad sampling frequency: {self.sfreq}")
+            #raise BadSamplingFreq(self.reader.sfreq)
+        # self.df = pd.DataFrame(self.edf.get_data().transpose(), columns=self.edf.ch_names)
 
-        # Add one second offset trying to avoid truncation errors in crop()
-        paddedDurations = rawAnnotations['duration'].astype(float) + 1
-        offsets = times + paddedDurations
-        offsetsIdxs = offsets.index[offsets > self.edf.duration].tolist()
+    @staticmethod
+    def sfreqTarget() -> float:
+        # Every session is brought to this rate before epoching, 0 keeps the one of the file.
+        return float(os.getenv("EDF_TARGET_SFREQ", 200))
 
-        if len(offsetsIdxs) > 0:
-            minOffset = min(offsetsIdxs)
-            stopIndex = min([stopIndex, minOffset])
+    @staticmethod
+    def analysisTarget() -> float:
+        # PSDs are computed on the signals decimated close to this frequency, 0 (default) keeps the original
+        # one: decimated features differ slightly, so it's opt-in to keep them comparable with existing models.
+        return float(os.getenv("EDF_PSD_SFREQ", 0))
 
-        # Discard events that are out of file boundaries
-        eventsIdxs = list(filter(lambda x: x < stopIndex, eventsIdxs))
-        
-        events = events.iloc[eventsIdxs]
-        times = times.iloc[eventsIdxs]
-        durations = rawAnnotations['duration'].iloc[eventsIdxs].astype(float)
+    @staticmethod
+    def featuresVersion() -> dict:
+        """ Everything the output of featuresPerEvent depends on, see FeatureStore. """
+        spectral = SpectralEngine()
+
+        return {
+            "revision": EdfParser.featuresRevision,
+            "stopEvent": EdfParser.stopEvent,
+            "annotationsTags": EdfParser.annotationsTags,
+            "tagsToClass": EdfParser.tagsToClass,
+            "freqBands": EdfParser.freqBands,
+            "fmin": EdfParser.fmin,
+            "fmax": EdfParser.fmax,
+            "epochDuration": EdfParser.epochDuration,
+            "targetSfreq": EdfParser.sfreqTarget(),
+            "analysisSfreq": EdfParser.analysisTarget(),
+            "psdMethod": spectral.method,
+            "psdBandwidth": spectral.bandwidth,
+            "psdWelchSegment": spectral.welchSegment if spectral.method == "welch" else None
+        }
+
+    def getData(self) -> np.ndarray:
+        """ (channels, samples) array with the picked signals at self.sfreq, decoded once. """
+        if self.data is None:
+            self.data = self.reader.readSignals(self.indices, self.dtype)
+            if self.sfreq != self.reader.sfreq:
+                self.data, _ = SpectralEngine.resample(self.data, self.reader.sfreq, self.targetSfreq)
+        return self.data
+
+    @property
+    def edf(self) -> mne.io.RawArray:
+        # Only the paths still relying on mne (epochs, psd, crop) pay for an mne Raw.
+        if self.raw is None:
+            self.raw = self.reader.toRaw(self.indices, self.getData(), self.sfreq)
+            if self.annotations is not None:
+                self.raw.set_annotations(self.annotations, emit_warning=False)
+        return self.raw
+
+    def __analysisData(self):
+        # Features are only taken between fmin and fmax, most of the full rate spectrum would be wasted.
+        factor = SpectralEngine.decimationFactor(self.sfreq, self.analysisSfreq, self.fmax)
+        if factor == 1:
+            return self.getData(), self.sfreq
 
-        return times, events, durations
+        if self.analysis is None:
+            self.analysis = SpectralEngine.decimate(self.getData(), self.sfreq, factor, self.fmax)
 
+        return self.analysis, self.sfreq / factor
+
+    def getChannelTypes(self):
+        return self.reader.types
+    
+    @classmethod
+    def annotationCompiler(cls) -> AnnotationCompiler:
+        # Shared by every session, rebuilt only if the tags are replaced.
+        compiler = cls.compiler
+        if compiler is None or compiler.annotationsTags is not cls.annotationsTags or compiler.tagsToClass is not cls.tagsToClass or compiler.stopEvent != cls.stopEvent:
+            compiler = AnnotationCompiler(cls.annotationsTags, cls.tagsToClass, cls.stopEvent)
+            cls.compiler = compiler
+
+        return compiler
 
     def setAnottations(self, rawAnnotations: pd.DataFrame):
 
-        times, events, durations = self.__selectAnnotations(rawAnnotations)
+        onsets, durations, tags, labels = self.annotationCompiler().compile(rawAnnotations, self.reader.measDate, self.reader.duration)
 
         annotations = mne.Annotations(
-            onset=times, 
+            onset=onsets, 
             orig_time=None, 
             duration=durations, 
-            description=events
+            description=tags
         )
 
-        self.edf.set_annotations(annotations, emit_warning=False)
         self.annotations = annotations
-        self.tags = events
+        if self.raw is not None:
+            self.raw.set_annotations(annotations, emit_warning=False)
+        self.tags = tags
+        self.labels = labels
     
     def __getEventIds(self, present): 
         eventId = {}
@@ -123,60 +599,272 @@ class EdfParser:
 
         return eventId
 
-    def __getEpochs(self):
-        events, _ = mne.events_from_annotations(self.edf, event_id=self.tagsToClass, chunk_duration=30.0)
+    def __getEpochs(self, raw: mne.io.RawArray):
+        events, _ = mne.events_from_annotations(raw, event_id=self.tagsToClass, chunk_duration=self.epochDuration)
         
         return mne.Epochs(
-            raw=self.edf,
+            raw=raw,
             events=events,
             event_id=self.__getEventIds(np.unique(events[:, -1])),
             tmin=0.0,
-            tmax=30.0 - 1.0 / self.edf.info["sfreq"],
+            tmax=self.epochDuration - 1.0 / raw.info["sfreq"],
             baseline=None,
             on_missing="raise"
         )
 
-    def featuresPerEvent(self, picks: pd.DataFrame):
+    def epochStarts(self, sfreq: float, nTimes: int, size: int = None, repeated = False):
+        """
+            First sample and label of every epoch, the annotations split in chunks of epochDuration as
+            mne.events_from_annotations(chunk_duration) does, epochs not fully inside the signals dropped
+            as mne.Epochs does. Returns (starts, labels, samples per epoch). Epochs starting at the same
+            sample raise RepeatedEvents, as in mne.Epochs, unless repeated (all of them are kept).
+        """
+        if self.annotations is None:
+            raise Exception("Trying to epoch a not annotated document")
+
+        tolerance = 1e-8
+        if size is None:
+            size = int(round((self.epochDuration - 1.0 / sfreq) * sfreq)) + 1
+
+        # Annotations are sorted by onset, cropped to the recording as Raw.set_annotations does.
+        onsets = self.annotations.onset
+        ends = onsets + np.nan_to_num(self.annotations.duration)
+        codes = self.annotationCompiler().codesOf(self.annotations.description)
+        labels = np.where(codes >= 0, self.annotationCompiler().labels[codes], -1)
+
+        inside = (onsets <= nTimes / sfreq) & (ends >= 0) & (labels >= 0)
+        onsets = np.clip(onsets[inside], 0, None)
+        ends = np.clip(ends[inside], None, nTimes / sfreq)
+        labels = labels[inside]
+
+        # Chunks per annotation, the last one is discarded unless it lasts the whole epochDuration.
+        counts = np.maximum(np.floor((ends - onsets - self.epochDuration + tolerance) / self.epochDuration).astype(int) + 1, 0)
+        firsts = np.repeat(np.cumsum(counts) - counts, counts)
+
+        chunkOnsets = np.repeat(onsets, counts) + (np.arange(counts.sum()) - firsts) * self.epochDuration
+        starts = np.round(chunkOnsets * sfreq).astype(int)
+        labels = np.repeat(labels, counts)
+
+        if len(starts) == 0:
+            raise NoEvents()
+
+        if not repeated and len(np.unique(starts)) != len(starts):
+            raise RepeatedEvents()
+
+        within = starts + size <= nTimes
+        if not within.any():
+            raise NoEvents()
+
+        return starts[within], labels[within], size
+
+    @staticmethod
+    def epochView(data: np.ndarray, starts: np.ndarray, size: int) -> np.ndarray:
+        """
+            (epochs, channels, size) epochs of (channels, samples) data. A view when the starts are evenly
+            spaced (back to back epochs, the usual case), a gathered copy otherwise.
+        """
+        windows = np.lib.stride_tricks.sliding_window_view(data, size, axis=-1)
+        steps = np.diff(starts)
+
+        if len(starts) == 1 or (steps[0] > 0 and (steps == steps[0]).all()):
+            step = steps[0] if len(starts) > 1 else 1
+            epochs = windows[:, starts[0]::step][:, :len(starts)]
+        else:
+            epochs = windows[:, starts]
+
+        return epochs.transpose(1, 0, 2)
+
+    def epochs(self, data: np.ndarray, sfreq: float):
+        """ (epochs view, labels) of the annotated events of data, (channels, samples) at sfreq. """
+        starts, labels, size = self.epochStarts(sfreq, data.shape[-1])
+        return EdfParser.epochView(data, starts, size), labels
+
+    def __features(self, epochData: np.ndarray, sfreq: float, labels: np.ndarray):
+        psds, freqs = self.spectral.psd(epochData, sfreq, fmin=self.fmin, fmax=self.fmax)
+
+        # Events where no presence/power is found in the given frequencies are deleted, the PSDs normalized
+        features, kept = SpectralEngine.bandFeatures(psds, freqs, self.freqBands)
+
+        return features, labels[kept]
+
+    def iterFeatures(self, picks: pd.DataFrame, epochsPerWindow: int = None):
+        """
+            featuresPerEvent in batches: the recording is walked in windows of epochsPerWindow epochs
+            (EDF_STREAM_EPOCHS), each one decoded, resampled and decimated on its own (with enough
+            margin for the filters to give the same values as the whole night) and yielded as
+            (features, labels). Memory doesn't depend on the length of the recording, unless a picked
+            signal has a lower rate than the others (those are upsampled over the whole recording).
+        """
+        epochsPerWindow = (int(os.getenv("EDF_STREAM_EPOCHS", 0)) or 120) if epochsPerWindow is None else epochsPerWindow
+        positions = [self.names.index(name) for name in picks["name"].to_list()]
+        indices = [self.indices[position] for position in positions]
+
+        # Rates: read (0) -> resampled to targetSfreq (1) -> decimated for the analysis (2). Lower rate picks are
+        # read from getData(), already at targetSfreq, so the windows are only decimated.
+        if not all(self.reader.isFullRate(index) for index in indices):
+            data = self.getData()[positions]
+            read = lambda start, stop: data[:, start:stop]
+            readTimes = data.shape[-1]
+            up, down = 1, 1
+        else:
+            read = lambda start, stop: np.stack([self.reader.signalRange(index, start, stop, self.dtype) for index in indices])
+            readTimes = self.reader.nTimes
+            up, down = SpectralEngine.resamplingRatio(self.reader.sfreq, self.sfreq) if self.sfreq != self.reader.sfreq else (1, 1)
+
+        factor = SpectralEngine.decimationFactor(self.sfreq, self.analysisSfreq, self.fmax)
+        sfreq = self.sfreq / factor
+
+        nTimes = -(-(-(-readTimes * up // down)) // factor)
+        starts, labels, size = self.epochStarts(sfreq, nTimes)
+
+        # Filter supports, in read samples, and the window alignment keeping both output grids as the whole night's.
+        support = (len(SpectralEngine.resamplingFilter(up, down)) // 2 / up if up != down else 0) + 2
+        if factor > 1:
+            support += (len(SpectralEngine.decimationFilter(self.sfreq, factor, self.fmax)) // 2 + 1) * down / up
+        margin = int(np.ceil(support * up / (down * factor))) + 1
+        align = up // np.gcd(factor, up)
+
+        for first in range(0, len(starts), epochsPerWindow):
+            windowStarts = starts[first:first + epochsPerWindow]
+            begin = max((windowStarts[0] - margin) // align * align, 0)
+            end = windowStarts[-1] + size + margin
+
+            segment = read(begin * factor * down // up, min(-(-end * factor * down // up), readTimes))
+            if up != down:
+                segment, _ = SpectralEngine.resample(segment, self.reader.sfreq, self.sfreq)
+            segment = SpectralEngine.decimate(segment, self.sfreq, factor, self.fmax)
+
+            epochData = EdfParser.epochView(segment, windowStarts - begin, size)
+            yield self.__features(epochData, sfreq, labels[first:first + epochsPerWindow])
+
+    def streamedFeatures(self, picks: pd.DataFrame, epochsPerWindow: int = None):
+        """ featuresPerEvent through iterFeatures, the windows of the session joined (numpy epoching only). """
+        windows = list(self.iterFeatures(picks, epochsPerWindow))
+        if len(windows) == 0:
+            return self.featuresPerEvent(picks)
+
+        return np.concatenate([features for features, _ in windows]), np.concatenate([labels for _, labels in windows])
+
+    def epochData(self, picks: pd.DataFrame):
+        """ (epochs, sfreq, labels) featuresPerEvent computes its PSDs from, epochs shaped (epochs, channels, samples). """
         # https://mne.tools/stable/auto_tutorials/clinical/60_sleep.html
 
         chann_names = picks["name"].to_list()
-        epochs = self.__getEpochs()
-        
-        spectrum = epochs.compute_psd(picks=chann_names, fmin=0.5, fmax=30.0, method="multitaper").reorder_channels(chann_names)
-        psds, freqs = spectrum.get_data(return_freqs=True)
+        data, sfreq = self.__analysisData()
+
+        if self.epoching == "mne":
+            epochs = self.__getEpochs(self.reader.toRaw(self.indices, data, sfreq).set_annotations(self.annotations, emit_warning=False))
+            return epochs.get_data(picks=chann_names), sfreq, epochs.events[:, 2]
+
+        epochData, labels = self.epochs(data, sfreq)
+        positions = [self.names.index(name) for name in chann_names]
+        if positions != list(range(len(self.names))):
+            epochData = epochData[:, positions]
+
+        return epochData, sfreq, labels
+
+    def featuresPerEvent(self, picks: pd.DataFrame):
+        return self.__features(*self.epochData(picks))
+
+    @staticmethod
+    def batchFeatures(prepared: list, spectral: SpectralEngine = None, batchEpochs: int = None) -> list:
+        """
+            featuresPerEvent of many sessions at once, from the (epochs, sfreq, labels) of their epochData().
+            Sessions sharing sfreq and epoch shape go through the same PSD calls, batchEpochs
+            (EDF_PSD_BATCH_EPOCHS) epochs at a time. Returns the (features, labels) of every session, in order.
+        """
+        spectral = SpectralEngine() if spectral is None else spectral
+        batchEpochs = int(os.getenv("EDF_PSD_BATCH_EPOCHS", 256)) if batchEpochs is None else batchEpochs
+
+        features = [[] for _ in prepared]
+        kept = [[] for _ in prepared]
+
+        def flush(sfreq: float, pieces: list):
+            data = np.concatenate([prepared[session][0][start:stop] for session, start, stop in pieces])
+            psds, freqs = spectral.psd(data, sfreq, fmin=EdfParser.fmin, fmax=EdfParser.fmax)
+            batch, mask = SpectralEngine.bandFeatures(psds, freqs, EdfParser.freqBands)
+
+            # Split back per session, dropped epochs included.
+            position, offset = 0, 0
+            for session, start, stop in pieces:
+                pieceMask = mask[position:position + stop - start]
+                features[session].append(batch[offset:offset + pieceMask.sum()])
+                kept[session].append(pieceMask)
+                position += stop - start
+                offset += pieceMask.sum()
 
-        # Delete events where no presence/power is found in the given frequencies
-        purged_psds = np.delete(psds, np.where(np.sum(psds, axis=-1) == 0)[0], axis=0)
+        groups = {}
+        for session, (epochData, sfreq, _) in enumerate(prepared):
+            groups.setdefault((sfreq, epochData.shape[1:]), []).append(session)
 
-        # Remove useless labels
-        labels = np.delete(epochs.events[:, 2], np.where(np.sum(psds, axis=-1) == 0)[0])
+        for (sfreq, _), sessions in groups.items():
+            pieces, count = [], 0
+            for session in sessions:
+                start, epochCount = 0, len(prepared[session][0])
+                while start < epochCount:
+                    stop = min(epochCount, start + batchEpochs - count)
+                    pieces.append((session, start, stop))
+                    count += stop - start
+                    start = stop
 
-        # Normalize the PSDs
-        purged_psds /= np.sum(purged_psds, axis=-1, keepdims=True)
+                    if count == batchEpochs:
+                        flush(sfreq, pieces)
+                        pieces, count = [], 0
 
-        X = []
-        for fmin, fmax in self.freqBands.values():
-            psds_band = purged_psds[:, :, (freqs >= fmin) & (freqs < fmax)].mean(axis=-1)
-            X.append(psds_band.reshape(len(purged_psds), -1))
+            if len(pieces) > 0:
+                flush(sfreq, pieces)
 
-        return np.concatenate(X, axis=1), labels
+        results = []
+        for session, (epochData, _, labels) in enumerate(prepared):
+            if len(features[session]) == 0:
+                results.append((np.empty((0, len(EdfParser.freqBands) * epochData.shape[1])), labels[:0]))
+            else:
+                results.append((np.concatenate(features[session]), labels[np.concatenate(kept[session])]))
 
-    def crop(self, channelPicks: list):
+        return results
+
+    def crop(self, channelPicks: list, asArray = False):
+        """
+            Annotated chunks of the given channels, a list of mne Raws (crop_by_annotations) by default.
+            With asArray a contiguous float32 (epochs, samples, channels) array, in the units of
+            Raw.to_data_frame(), is returned along with the tags of every epoch instead. Epochs are the
+            ones of featuresPerEvent with one sample more (6001 at 200Hz), the length crop_by_annotations
+            gives for a 30s annotation and the input of EEGModel. Repeated annotations are all kept, as
+            crop_by_annotations does.
+        """
         if self.annotations is None:
             raise Exception("Trying to crop a not annotated document") 
-        picks = self.edf.pick(channelPicks).reorder_channels(channelPicks)
-        return picks.crop_by_annotations()
+
+        if not asArray:
+            picks = self.edf.pick(channelPicks).reorder_channels(channelPicks)
+            return picks.crop_by_annotations()
+
+        data = self.getData()
+        starts, tags, size = self.epochStarts(self.sfreq, data.shape[-1], int(round(self.epochDuration * self.sfreq)) + 1, True)
+        epochs = EdfParser.epochView(data, starts, size)
+
+        chunks = np.empty((len(starts), size, len(channelPicks)), dtype=np.float32)
+        for column, name in enumerate(channelPicks):
+            position = self.names.index(name)
+            scaling = EdfReader.dataFrameScalings.get(self.reader.types[self.reader.signals.index(self.indices[position])], 1.0)
+            np.multiply(epochs[:, position], scaling, out=chunks[:, :, column], casting="unsafe")
+
+        return chunks, tags
     
     def getTags(self):
-        return list(map(lambda t: self.tagsToClass[t], self.tags))
+        return self.labels.tolist()
 
     def getInfo(self):
         return self.edf.info
     
-    # https://github.com/mne-tools/mne-python/pull/13156
     def purge(self):
-        os.remove(self.filename)
+        self.reader.close()
+        self.data = None
+        self.raw = None
+        self.analysis = None
+        if self.ownsFile and os.path.exists(self.filename):
+            os.remove(self.filename)
     
     def duration(self):
-        return self.edf.duration
+        return self.reader.duration
 
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+import numpy as np
+
+class FeatureStore():
+    """
+        Persistent store of the features (and labels) computed per session, so sessions already
+        seen are never downloaded again. Shards are compressed .npz files keyed by site, subject,
+        session and channel selection, under a folder named after the hash of the feature
+        extractor version (see EdfParser.featuresVersion): changing the bands, the annotation
+        tags or the PSD settings starts a new, empty, store. Safe to share between threads.
+    """
+    def __init__(self, path: str, version: dict):
+        self.version = version
+        self.digest = hashlib.sha256(json.dumps(version, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(path, self.digest)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+        versionFile = os.path.join(self.path, "version.json")
+        if not os.path.exists(versionFile):
+            with open(versionFile, "w") as fp:
+                json.dump(version, fp, sort_keys=True, indent=4)
+
+    def __shardPath(self, site: str, sub: str, session, picks: list) -> str:
+        selection = hashlib.sha256("|".join(picks).encode()).hexdigest()[:12]
+        return os.path.join(self.path, site, sub, f"ses-{session}-{selection}.npz")
+
+    def get(self, site: str, sub: str, session, picks: list):
+        """ (features, labels) stored for the session and channel selection, None if there aren't any. """
+        try:
+            with np.load(self.__shardPath(site, sub, session, picks)) as shard:
+                features, labels = shard["features"], shard["labels"]
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Missing or unreadable (partially written by an older version) shards are recomputed.
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return features, labels
+
+    def put(self, site: str, sub: str, session, picks: list, features: np.ndarray, labels: list):
+        path = self.__shardPath(site, sub, session, picks)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        # Written aside and renamed, readers never see a partial shard.
+        with tempfile.NamedTemporaryFile(dir=folder, suffix=".part", delete=False) as fp:
+            try:
+                np.savez_compressed(fp, features=np.asarray(features), labels=np.asarray(labels))
+            except BaseException:
+                fp.close()
+                os.remove(fp.name)
+                raise
+
+        os.replace(fp.name, path)
+
+        with self.lock:
+            self.writes += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "version": self.digest,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes
+            }
@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+
+class Manifest():
+    """
+        Local SQLite index of the bucket objects (key, size and ETag), built per site from a
+        paginated listing of PSG/bids/<site>/. Once a site is indexed, existence checks and
+        folder listings for it are answered locally without any request to the bucket.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+        with self.__conn() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode = WAL;
+
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT PRIMARY KEY,
+                    site TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS objects_site_idx ON objects (site);
+
+                CREATE TABLE IF NOT EXISTS sites (
+                    site TEXT PRIMARY KEY,
+                    objects INTEGER NOT NULL,
+                    built TEXT NOT NULL
+                );
+            """)
+
+    def __conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, one per worker.
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = sqlite3.connect(self.path, timeout=60)
+        return self.local.conn
+
+    @staticmethod
+    def siteOf(key: str) -> str:
+        # PSG/bids/{site}/...
+        parts = key.split("/")
+        return parts[2] if len(parts) > 3 else None
+
+    def __prefixBounds(self, prefix: str):
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def build(self, site: str, pages) -> int:
+        """ Replaces the site's index with the given listing pages (list_objects_v2 "Contents"). """
+        count = 0
+        with self.__conn() as conn:
+            conn.execute("DELETE FROM objects WHERE site = ?;", (site,))
+            for page in pages:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO objects (key, site, size, etag) VALUES (?, ?, ?, ?);",
+                    [(item["Key"], site, item["Size"], item["ETag"]) for item in page]
+                )
+                count += len(page)
+            conn.execute("INSERT OR REPLACE INTO sites (site, objects, built) VALUES (?, ?, datetime('now'));", (site, count))
+
+        return count
+
+    def hasSite(self, site: str) -> bool:
+        cursor = self.__conn().execute("SELECT 1 FROM sites WHERE site = ?;", (site,))
+        return cursor.fetchone() is not None
+
+    def covers(self, key: str) -> bool:
+        site = Manifest.siteOf(key)
+        return site is not None and self.hasSite(site)
+
+    def get(self, key: str) -> dict:
+        cursor = self.__conn().execute("SELECT size, etag FROM objects WHERE key = ?;", (key,))
+        result = cursor.fetchone()
+
+        return None if result is None else { "Size": result[0], "ETag": result[1] }
+
+    def listFolders(self, prefix: str) -> list:
+        cursor = self.__conn().execute("SELECT key FROM objects WHERE key >= ? AND key < ?;", self.__prefixBounds(prefix))
+        folders = set()
+        for (key,) in cursor:
+            rest = key[len(prefix):]
+            if "/" in rest:
+                folders.add(prefix + rest.split("/")[0] + "/")
+
+        return sorted(folders)
+
+    def listFiles(self, prefix: str) -> list:
+        cursor = self.__conn().execute("SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key;", self.__prefixBounds(prefix))
+        return [key for (key,) in cursor if "/" not in key[len(prefix):]]
@@ -41,6 +41,9 @@ class MLPEegModel():
         self.dir = os.getenv("MODEL_CHECKPOINT_DIR") #+ "old/mlp-smote-max-22-05-2025/"
         self.db = Db()
 
+        # "dataset" feeds model.fit with tf.data pipelines (Db.dataset), "generator" with Db.readChunks.
+        self.input = os.getenv("MODEL_INPUT", "dataset")
+
         self.callbacks = [
             keras.callbacks.ReduceLROnPlateau(
                 monitor="val_loss",
@@ -130,15 +133,26 @@ class MLPEegModel():
 
     def fit(self):
 
-        history = self.model.fit(
-            self.db.readChunks(self.batch_size, self.epochs),
-            epochs=self.epochs,
-            steps_per_epoch=math.ceil(self.db.sampleNum() / self.batch_size),
-            validation_data=self.db.readChunks(self.batch_size, self.epochs, "validation"),
-            validation_steps=math.ceil(self.db.sampleNum("validation") / self.batch_size),
-            verbose=1,
-            callbacks=[self.callbacks]
-        )
+        if self.input == "dataset":
+            history = self.model.fit(
+                self.db.dataset(self.batch_size),
+                epochs=self.epochs,
+                validation_data=self.db.dataset(self.batch_size, "validation"),
+                verbose=1,
+                callbacks=[self.callbacks]
+            )
+
+            self.db.clearDatasetCaches()
+        else:
+            history = self.model.fit(
+                self.db.readChunks(self.batch_size, self.epochs),
+                epochs=self.epochs,
+                steps_per_epoch=math.ceil(self.db.sampleNum() / self.batch_size),
+                validation_data=self.db.readChunks(self.batch_size, self.epochs, "validation"),
+                validation_steps=math.ceil(self.db.sampleNum("validation") / self.batch_size),
+                verbose=1,
+                callbacks=[self.callbacks]
+            )
 
         cat_acc = np.mean(history.history['categorical_accuracy'])
         val_cat_acc = np.mean(history.history['val_categorical_accuracy'])
@@ -21,6 +21,9 @@ class EEGModel():
 
         self.db = Db()
 
+        # "dataset" feeds model.fit with tf.data pipelines (Db.dataset), "generator" with Db.readChunks.
+        self.input = os.getenv("MODEL_INPUT", "dataset")
+
         self.epochs = 5
         self.tuner_epochs = 2
         self.batch_size = 64
@@ -129,14 +132,24 @@ class EEGModel():
 
     def fit(self):
         
-        history = self.model.fit(
-            self.db.readChunks(self.batch_size, self.epochs),
-            epochs=self.epochs,
-            steps_per_epoch=math.ceil(self.db.sampleNum() / self.batch_size),
-            validation_data=self.db.readChunks(self.batch_size, self.epochs, "validation"),
-            validation_steps=math.ceil(self.db.sampleNum("validation_tags") / self.batch_size),
-            verbose=0
-        )
+        if self.input == "dataset":
+            history = self.model.fit(
+                self.db.dataset(self.batch_size),
+                epochs=self.epochs,
+                validation_data=self.db.dataset(self.batch_size, "validation"),
+                verbose=0
+            )
+
+            self.db.clearDatasetCaches()
+        else:
+            history = self.model.fit(
+                self.db.readChunks(self.batch_size, self.epochs),
+                epochs=self.epochs,
+                steps_per_epoch=math.ceil(self.db.sampleNum() / self.batch_size),
+                validation_data=self.db.readChunks(self.batch_size, self.epochs, "validation"),
+                validation_steps=math.ceil(self.db.sampleNum("validation_tags") / self.batch_size),
+                verbose=0
+            )
 
         cat_acc = np.mean(history.history['categorical_accuracy'])
         val_cat_acc = np.mean(history.history['val_categorical_accuracy'])
@@ -0,0 +1,130 @@
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class Pipeline():
+    """
+        Streams items through a download stage and an optional compute stage, each one with its own
+        thread pool, keeping at most `window` items in flight. There is no chunk barrier: as soon as
+        an item leaves the window (once the consumer, the sink, is done with it) the next one is admitted,
+        so network I/O, computation and the sink overlap continuously.
+
+        With a cost function (item -> bytes it will hold in memory) and a budget, items are also only
+        admitted while the cost of the ones in flight stays under the budget: many small recordings
+        run at once, a huge one runs with few (or alone, if it doesn't fit in the budget by itself).
+    """
+    def __init__(self, download, compute = None, downloadWorkers = 4, computeWorkers = 2, window = 8, cost = None, budget = 0):
+        self.download = download
+        self.compute = compute
+        self.downloadWorkers = downloadWorkers
+        self.computeWorkers = computeWorkers
+        self.window = max(window, 1)
+        self.cost = cost
+        self.budget = budget
+
+        # Amount of leading items (in input order) already handed to the sink, the current one included,
+        # usable as a checkpoint once the sink is done with it.
+        self.watermark = 0
+
+        self.inFlightCost = 0
+        self.peakCost = 0
+        self.peakInFlight = 0
+
+    def __costOf(self, item) -> int:
+        if self.cost is None or self.budget <= 0:
+            return 0
+
+        try:
+            return self.cost(item)
+        except Exception:
+            # Unknown size (missing object, ...), its download will fail on its own.
+            return 0
+
+    def __forward(self, item, future: Future, computes: ThreadPoolExecutor, done: queue.Queue):
+        if self.compute is None or future.exception() is not None:
+            done.put((item, future))
+            return
+
+        try:
+            computed = computes.submit(self.compute, future.result())
+            computed.add_done_callback(lambda f: done.put((item, f)))
+        except RuntimeError as ex:
+            # Executor shutting down because the consumer stopped early.
+            failed = Future()
+            failed.set_exception(ex)
+            done.put((item, failed))
+
+    def run(self, items, ordered = False):
+        """
+            Yields (item, future) in completion order, future.result() returns the compute stage
+            result (or the download one if there's no compute stage) or raises its exception.
+
+            ordered yields them in input order instead: items finished ahead of the watermark are
+            held (still counting in the window) until the ones before them are yielded, so every
+            item yielded is covered by the watermark and nothing past it has reached the sink.
+        """
+        done = queue.Queue()
+        finished = {}
+        iterator = enumerate(items)
+        exhausted = False
+        waiting = None
+        pending = 0
+        consumed = set()
+        costs = {}
+        self.watermark = 0
+        self.inFlightCost = 0
+
+        with ThreadPoolExecutor(max_workers=self.downloadWorkers) as downloads, ThreadPoolExecutor(max_workers=self.computeWorkers) as computes:
+            while True:
+                while not exhausted and pending < self.window:
+                    if waiting is None:
+                        try:
+                            position, item = next(iterator)
+                        except StopIteration:
+                            exhausted = True
+                            break
+
+                        waiting = (position, item, self.__costOf(item))
+
+                    position, item, cost = waiting
+                    if pending > 0 and self.inFlightCost + cost > self.budget:
+                        break
+
+                    waiting = None
+                    future = downloads.submit(self.download, item)
+                    future.add_done_callback(lambda f, entry=(position, item): self.__forward(entry, f, computes, done))
+                    pending += 1
+
+                    costs[position] = cost
+                    self.inFlightCost += cost
+                    self.peakCost = max(self.peakCost, self.inFlightCost)
+                    self.peakInFlight = max(self.peakInFlight, pending)
+
+                if pending == 0:
+                    break
+
+                (position, item), future = done.get()
+                finished[position] = (item, future)
+
+                while finished:
+                    position = self.watermark if ordered else next(iter(finished))
+                    if position not in finished:
+                        break
+
+                    item, future = finished.pop(position)
+                    pending -= 1
+
+                    consumed.add(position)
+                    while self.watermark in consumed:
+                        consumed.remove(self.watermark)
+                        self.watermark += 1
+
+                    yield item, future
+
+                    self.inFlightCost -= costs.pop(position)
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "peakCost": self.peakCost,
+            "peakInFlight": self.peakInFlight
+        }
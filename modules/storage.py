@@ -0,0 +1,217 @@
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+import boto3 as aws
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+class PoolFullCounter(logging.Handler):
+    """ Counts urllib3's "Connection pool is full" warnings, they mean requests outnumber the pool. """
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        if "pool is full" in record.getMessage():
+            self.count += 1
+
+class S3Storage():
+    """
+        Objects served from the S3 bucket. Listing pages follow list_objects_v2
+        ("Contents" with Key/Size/ETag and "CommonPrefixes" with Prefix).
+    """
+    def __init__(self):
+        self.bucket = os.getenv("AWS_BUCKET")
+        self.region_name = os.getenv("AWS_REGION")
+        self.aws_access_key_id = os.getenv("AWS_KEY")
+        self.aws_secret_access_key = os.getenv("AWS_SECRET_KEY")
+        self.client = None
+        self.clientLock = threading.Lock()
+
+        # Every script shares one AWS() between its worker threads, size the pool accordingly.
+        self.maxPoolConnections = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", 50))
+        self.tcpKeepalive = os.getenv("AWS_TCP_KEEPALIVE", "1") == "1"
+        self.transferConfig = TransferConfig(
+            multipart_threshold=int(os.getenv("AWS_MULTIPART_THRESHOLD_MB", 8)) * 1024 * 1024,
+            multipart_chunksize=int(os.getenv("AWS_MULTIPART_CHUNK_MB", 8)) * 1024 * 1024,
+            max_concurrency=int(os.getenv("AWS_TRANSFER_CONCURRENCY", 10))
+        )
+
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.requests = 0
+        self.statsLock = threading.Lock()
+        self.poolFull = PoolFullCounter()
+        logging.getLogger("urllib3.connectionpool").addHandler(self.poolFull)
+
+    def __beforeSend(self, **kwargs):
+        with self.statsLock:
+            self.requests += 1
+
+    @contextmanager
+    def __tracked(self):
+        # Released in finally, a failed call (network error, missing key, ...) must not stay counted.
+        with self.statsLock:
+            self.inFlight += 1
+            self.peakInFlight = max(self.peakInFlight, self.inFlight)
+
+        try:
+            yield
+        finally:
+            with self.statsLock:
+                self.inFlight -= 1
+
+    def __getAwsCli(self):
+
+        # boto3 sessions aren't thread safe, the client is built once under the lock and then shared.
+        with self.clientLock:
+            if self.client is None:
+                session = aws.Session(
+                    region_name = self.region_name,
+                    aws_access_key_id = self.aws_access_key_id,
+                    aws_secret_access_key = self.aws_secret_access_key
+                )
+
+                client = session.client('s3', config=Config(
+                    max_pool_connections=self.maxPoolConnections,
+                    tcp_keepalive=self.tcpKeepalive
+                ))
+
+                client.meta.events.register("before-send.s3", self.__beforeSend)
+                self.client = client
+
+        return self.client
+
+    def download(self, key: str, file):
+        with self.__tracked():
+            self.__getAwsCli().download_fileobj(self.bucket, key, file, Config=self.transferConfig)
+
+    def downloadFile(self, key: str, dest: str):
+        with self.__tracked():
+            self.__getAwsCli().download_file(self.bucket, key, dest, Config=self.transferConfig)
+
+    def etag(self, key: str) -> str:
+        with self.__tracked():
+            return self.__getAwsCli().head_object(Bucket=self.bucket, Key=key)["ETag"]
+
+    def size(self, key: str) -> int:
+        with self.__tracked():
+            return self.__getAwsCli().head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+
+    def getRange(self, key: str, start: int, end: int):
+        """ Bytes [start, end) of the object, along with the object's total size. """
+        with self.__tracked():
+            response = self.__getAwsCli().get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+
+            return response["Body"].read(), int(response["ContentRange"].split("/")[-1])
+
+    def paginate(self, prefix: str, delimiter: str = None):
+        paginator = self.__getAwsCli().get_paginator("list_objects_v2")
+        params = { "Bucket": self.bucket, "Prefix": prefix }
+        if delimiter is not None:
+            params["Delimiter"] = delimiter
+
+        return paginator.paginate(**params)
+
+    def localPath(self, key: str) -> str:
+        return None
+
+    def stats(self) -> dict:
+        """
+            Storage calls in flight (a multipart transfer may hold several connections) and HTTP requests
+            sent, the connection pool is saturated if poolFull > 0.
+        """
+        with self.statsLock:
+            return {
+                "maxPoolConnections": self.maxPoolConnections,
+                "requests": self.requests,
+                "inFlight": self.inFlight,
+                "peakInFlight": self.peakInFlight,
+                "poolFull": self.poolFull.count
+            }
+
+class LocalStorage():
+    """
+        Same key layout as the bucket (PSG/bids/{site}/{sub}/ses-{n}/eeg/...) served from a local
+        mirror directory, for offline runs and for benchmarks without network variance.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.requests = 0
+        self.statsLock = threading.Lock()
+
+    def __path(self, key: str) -> str:
+        with self.statsLock:
+            self.requests += 1
+
+        path = os.path.join(self.root, *key.split("/"))
+        if not os.path.isfile(path):
+            # Same error boto3 raises, so callers handle missing objects as with S3.
+            raise ClientError({ "Error": { "Code": "NoSuchKey", "Message": f"{key} not found in {self.root}" } }, "GetObject")
+
+        return path
+
+    def download(self, key: str, file):
+        with open(self.__path(key), "rb") as fp:
+            shutil.copyfileobj(fp, file, 1024 * 1024)
+
+    def downloadFile(self, key: str, dest: str):
+        shutil.copyfile(self.__path(key), dest)
+
+    def etag(self, key: str) -> str:
+        stat = os.stat(self.__path(key))
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.__path(key))
+
+    def getRange(self, key: str, start: int, end: int):
+        path = self.__path(key)
+        with open(path, "rb") as fp:
+            return os.pread(fp.fileno(), end - start, start), os.path.getsize(path)
+
+    def paginate(self, prefix: str, delimiter: str = None):
+        """ Single page with the same shape as list_objects_v2's. """
+        folder = os.path.join(self.root, *prefix.split("/")[:-1])
+        contents, prefixes = [], []
+
+        if os.path.isdir(folder):
+            base = "/".join(prefix.split("/")[:-1])
+            base = base + "/" if base != "" else ""
+
+            if delimiter is None:
+                for root, _, files in os.walk(folder):
+                    rel = os.path.relpath(root, self.root).replace(os.sep, "/")
+                    for name in files:
+                        key = f"{rel}/{name}"
+                        if key.startswith(prefix):
+                            contents.append(self.__entry(key, os.path.join(root, name)))
+            else:
+                for entry in os.scandir(folder):
+                    key = base + entry.name
+                    if not key.startswith(prefix):
+                        continue
+                    if entry.is_dir():
+                        prefixes.append({ "Prefix": key + delimiter })
+                    else:
+                        contents.append(self.__entry(key, entry.path))
+
+        return [{
+            "Contents": sorted(contents, key=lambda item: item["Key"]),
+            "CommonPrefixes": sorted(prefixes, key=lambda item: item["Prefix"])
+        }]
+
+    def __entry(self, key: str, path: str) -> dict:
+        stat = os.stat(path)
+        return { "Key": key, "Size": stat.st_size, "ETag": f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"' }
+
+    def localPath(self, key: str) -> str:
+        """ Files are already on disk, readers can open (or memory map) them in place. """
+        return self.__path(key)
+
+    def stats(self) -> dict:
+        with self.statsLock:
+            return { "root": self.root, "requests": self.requests }
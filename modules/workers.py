@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+class SharedArray():
+    """ Reference to an array left by a worker process in a shared memory segment, see share() and receive(). """
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+def share(value):
+    """ value with its arrays (also inside tuples, lists and dicts) moved to shared memory, called in the worker. """
+    if isinstance(value, np.ndarray):
+        segment = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, value.dtype, buffer=segment.buf)[...] = value
+        segment.close()
+
+        return SharedArray(segment.name, value.shape, value.dtype.str)
+
+    if isinstance(value, (tuple, list)):
+        return type(value)(share(item) for item in value)
+
+    if isinstance(value, dict):
+        return { key: share(item) for key, item in value.items() }
+
+    return value
+
+def receive(value):
+    """ Inverse of share(), called in the parent: arrays are copied out and their segments released. """
+    if isinstance(value, SharedArray):
+        segment = shared_memory.SharedMemory(name=value.name)
+        try:
+            return np.ndarray(value.shape, np.dtype(value.dtype), buffer=segment.buf).copy()
+        finally:
+            segment.close()
+            segment.unlink()
+
+    if isinstance(value, (tuple, list)):
+        return type(value)(receive(item) for item in value)
+
+    if isinstance(value, dict):
+        return { key: receive(item) for key, item in value.items() }
+
+    return value
+
+def work(task, args: tuple):
+    return share(task(*args))
+
+def startWorker(initializer):
+    # One process per worker already, FFTs don't need threads of their own unless asked to.
+    os.environ.setdefault("EDF_PSD_WORKERS", "1")
+
+    import mne
+    mne.set_log_level(verbose="CRITICAL")
+
+    if initializer is not None:
+        initializer()
+
+class ProcessWorkers():
+    """
+        Pool of forked worker processes for the CPU bound part of a script (EDF parsing, PSDs), out
+        of reach of the GIL. Workers live for the whole run, so mne and the spectral caches are loaded
+        once per worker, and return their arrays through shared memory instead of pickling them.
+
+        Workers are forked when the pool is built, so it must be built once the task functions are
+        defined but before the script opens connections or starts threads: anything created earlier
+        is inherited by every worker. initializer() runs in each worker once forked, to build the
+        objects (AWS clients, ...) each one must own.
+
+        The amount of workers is bounded by memoryBudget / sessionBytes, the memory a single task
+        is expected to need.
+    """
+    def __init__(self, workers: int = None, memoryBudget: int = None, sessionBytes: int = None, initializer = None):
+        workers = int(os.getenv("PROCESS_WORKERS", os.cpu_count())) if workers is None else workers
+        memoryBudget = int(os.getenv("PROCESS_MEMORY_MB", 0)) * 1024 * 1024 if memoryBudget is None else memoryBudget
+        sessionBytes = int(os.getenv("PROCESS_SESSION_MB", 2048)) * 1024 * 1024 if sessionBytes is None else sessionBytes
+
+        if memoryBudget > 0:
+            workers = min(workers, memoryBudget // sessionBytes)
+
+        self.workers = max(workers, 1)
+
+        # Started before forking so every worker registers its segments with the parent's tracker,
+        # which sees them unlinked by receive() instead of reporting them as leaked.
+        resource_tracker.ensure_running()
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=startWorker,
+            initargs=(initializer,)
+        )
+
+        # The fork context launches every worker on the first submit.
+        self.executor.submit(os.getpid).result()
+
+    def call(self, task, *args):
+        """ task(*args) run in a worker, blocks the calling thread until its result is received. """
+        return receive(self.executor.submit(work, task, args).result())
+
+    def shutdown(self):
+        self.executor.shutdown()
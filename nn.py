@@ -70,12 +70,11 @@ def isValidation(folder, session, site):
 
 def parseData(folder, session, site, channels): 
     
-    parser = aws.loadEegEdf(folder, session, site)
+    parser = aws.loadEegEdf(folder, session, site, picks=channels["name"].to_list())
     annotations = aws.loadEegAnnotationsCsv(folder, session, site)
 
     parser.setAnottations(annotations)
-    chunks = parser.crop(channels["name"].to_list())
-    tags = parser.getTags()
+    chunks, tags = parser.crop(channels["name"].to_list(), asArray = True)
     parser.purge()
 
     return chunks, tags
@@ -11,12 +11,11 @@ def getTestData(folder, session, site):
     
     channels = ChannSelector().select(aws.loadEegChannelsTsv(folder, session, site))
 
-    parser = aws.loadEegEdf(folder, session, site)
+    parser = aws.loadEegEdf(folder, session, site, picks=channels["name"].to_list())
     annotations = aws.loadEegAnnotationsCsv(folder, session, site)
 
     parser.setAnottations(annotations)
-    chunks = parser.crop(channels["name"].to_list())
-    tags = parser.getTags()
+    chunks, tags = parser.crop(channels["name"].to_list(), asArray = True)
     parser.purge()
 
     return chunks, tags
@@ -27,8 +26,4 @@ testInstances = db.getTest()
 for folder, session, site in testInstances[0:1]:
     chunks, tags = getTestData(folder, session, site)
 
-    data = []
-    for chunk in list(map(lambda x: x.to_data_frame(), chunks)):
-        data.append(chunk.drop(columns = "time"))
-
-    print(model.evaluate(data, tags))
+    print(model.evaluate(chunks, tags))
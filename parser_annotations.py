@@ -2,8 +2,8 @@ import math
 import pandas as pd
 import json
 from botocore.exceptions import ClientError
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from modules.aws import AWS
+from modules.pipeline import Pipeline
 from modules.utils import Utils
 
 aws = AWS()
@@ -29,9 +29,12 @@ def getInfoTask(row: pd.Series):
     site = row["SiteID"]
 
     if row['HasAnnotations'] == 'Y':
-        return aggregateAnnotations(aws.loadEegAnnotationsCsv(folder, session, site))
+        return aws.loadEegAnnotationsCsv(folder, session, site)
     else:
         return None
+
+def computeTask(rawAnnotations: pd.DataFrame):
+    return None if rawAnnotations is None else aggregateAnnotations(rawAnnotations)
  
 def durationsToCounts(durations: list) -> dict:
     counts = {}
@@ -66,23 +69,20 @@ def mergeAnnotations(aggregatedAnnotations: dict) -> None:
             }
 
 def parseMainTask():
-    getChunk = utils.chunkDataframe(pd.read_csv('bdsp_psg_master_20231101.csv'), CHUNK_SIZE)
+    rows = pd.read_csv('bdsp_psg_master_20231101.csv')
+    pipeline = Pipeline(getInfoTask, computeTask, CHUNK_SIZE, 2, 2 * CHUNK_SIZE)
 
-    for chunk in getChunk:
-        with ThreadPoolExecutor(max_workers=CHUNK_SIZE) as executor:
-            futureToRow = {executor.submit(getInfoTask, row): row for _, row in chunk.iterrows()}
-            for future in as_completed(futureToRow):
-                row = futureToRow[future]
-                try:
-                    aggregatedAnnotations = future.result()
-                    mergeAnnotations(aggregatedAnnotations)
+    for row, future in pipeline.run(row for _, row in rows.iterrows()):
+        try:
+            aggregatedAnnotations = future.result()
+            mergeAnnotations(aggregatedAnnotations)
 
-                except ClientError:
-                    print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except Exception as exc:
-                    print(f"Exception %s: %s"%(row["BidsFolder"], exc))
-                    pass
+        except ClientError:
+            print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except Exception as exc:
+            print(f"Exception %s: %s"%(row["BidsFolder"], exc))
+            pass
 
 
 parseMainTask()
@@ -93,3 +93,8 @@ with open("out/annotations.json", "w") as outfile:
 
     # 27-04-2025 Staging folder structure has changed since last viewed, there are no participants.tsv and bids_staging folder has been deleted on favour of bids folder
     # that is holding all the data for all the ¿sites?. I'm focusing on the patiens listed in "bdsp_psg_master_20231101.csv"
+
+if aws.getCacheStats() is not None:
+    print(f"Cache stats: {aws.getCacheStats()}")
+
+print(f"Pool stats: {aws.getPoolStats()}")
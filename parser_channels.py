@@ -1,9 +1,9 @@
 import pandas as pd
 import csv
 from botocore.exceptions import ClientError
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from modules.aws import AWS
+from modules.pipeline import Pipeline
 from modules.utils import Utils
 
 aws = AWS()
@@ -29,31 +29,28 @@ def getInfoTask(row: pd.Series):
 
 
 def parseMainTask(writer, file):
-    getChunk = utils.chunkDataframe(pd.read_csv('bdsp_psg_master_20231101.csv'), CHUNK_SIZE)
-
-    for chunk in getChunk:
-        with ThreadPoolExecutor(max_workers=CHUNK_SIZE) as executor:
-            futureToRow = {executor.submit(getInfoTask, row): row for _, row in chunk.iterrows()}
-            for future in as_completed(futureToRow):
-                row = futureToRow[future]
-                try:
-                    channels, count = future.result()
+    rows = pd.read_csv('bdsp_psg_master_20231101.csv')
+    pipeline = Pipeline(getInfoTask, downloadWorkers=CHUNK_SIZE, window=2 * CHUNK_SIZE)
+
+    for row, future in pipeline.run(row for _, row in rows.iterrows()):
+        try:
+            channels, count = future.result()
+            
+            if len(channels) != count:
+                raise BadChannelCount();
+
+            writer.writerow([row["BidsFolder"], row["SessionID"], count, "|".join(channels)])
+            file.flush()
                     
-                    if len(channels) != count:
-                        raise BadChannelCount();
-
-                    writer.writerow([row["BidsFolder"], row["SessionID"], count, "|".join(channels)])
-                    file.flush()
-                            
-                except ClientError:
-                    print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except BadChannelCount:
-                    print(f"Bad channel count: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except Exception as exc:
-                    print(f"Exception %s: %s"%(row["BidsFolder"], exc))
-                    pass
+        except ClientError:
+            print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except BadChannelCount:
+            print(f"Bad channel count: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except Exception as exc:
+            print(f"Exception %s: %s"%(row["BidsFolder"], exc))
+            pass
 
 
 utils.createDirIfNotExists("out")
@@ -63,3 +60,8 @@ with open('out/channels.csv','w') as channels:
 
     # 27-04-2025 Staging folder structure has changed since last viewed, there are no participants.tsv and bids_staging folder has been deleted on favour of bids folder
     # that is holding all the data for all the ¿sites?. I'm focusing on the patiens listed in "bdsp_psg_master_20231101.csv"
+
+if aws.getCacheStats() is not None:
+    print(f"Cache stats: {aws.getCacheStats()}")
+
+print(f"Pool stats: {aws.getPoolStats()}")
@@ -0,0 +1,14 @@
+import pandas as pd
+
+from modules.aws import AWS
+
+aws = AWS()
+
+def buildManifest():
+    sites = pd.read_csv('bdsp_psg_master_20231101.csv')["SiteID"].unique()
+
+    for site in sites:
+        count = aws.buildManifest(site)
+        print(f"Indexed {count} objects for site: {site}")
+
+buildManifest()
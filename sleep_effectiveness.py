@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 import math
 import numpy as np
@@ -6,9 +5,9 @@ import pandas as pd
 from dateutil import parser
 from botocore.exceptions import ClientError
 
-from modules.utils import Utils
 from modules.aws import AWS
 from modules.db_se import Db
+from modules.pipeline import Pipeline
 
 class NoInfo(Exception):
     pass
@@ -41,7 +40,6 @@ CHUNK_SIZE = 20
 SLEEPING = [ "Sleep_stage_N2", "Sleep_stage_2", "Sleep_stage_1", "Sleep_stage_N1", "Sleep_stage_N3", "Sleep_stage_3", "Sleep_stage_REM", "Sleep_stage_R" ]
 NOT_SLEEPING = [ "Sleep_stage_W" ]
 
-utils = Utils()
 aws = AWS()
 db = Db()
 
@@ -342,58 +340,64 @@ def getInfoTask(row):
     site = row["SiteID"]
 
     if row['HasAnnotations'] == 'Y' and row['PreSleepQuestionnaire'] == 'Y':
-        se = computeEffectiveness(aws.loadEegAnnotationsCsv(folder, session, site))
-        row = buildRow([folder, session, site], aws.loadEegPreSleepQuestCsv(folder, session, site))
-        row.append(se)
-        db.insertRow(row)
-        return se
+        return [folder, session, site], aws.loadEegAnnotationsCsv(folder, session, site), aws.loadEegPreSleepQuestCsv(folder, session, site)
     else:
         raise NoInfo()
 
+def computeTask(downloaded):
+    init, annotations, preSleep = downloaded
+
+    se = computeEffectiveness(annotations)
+    row = buildRow(init, preSleep)
+    row.append(se)
+    return row
+
 def getSleepEffectivenessAndPreSleepQuestionnaire():
-    getChunk = utils.chunkDataframe(pd.read_csv('bdsp_psg_master_20231101.csv'), CHUNK_SIZE)
-
-    for chunk in getChunk:
-        with ThreadPoolExecutor(max_workers=CHUNK_SIZE) as executor:
-            futureToRow = {executor.submit(getInfoTask, row): row for _, row in chunk.iterrows()}
-            for future in as_completed(futureToRow):
-                row = futureToRow[future]
-                try:
-                    
-                    future.result()
-
-                except MissingInterestInResearch:
-                    print(f"Missing interest in research for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except UnableToComputeEffectiveness:
-                    print(f"Unable to compute effectiveness for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except MissingSmoke:
-                    print(f"Missing smoke for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except BadFallAsleep:
-                    print(f"Bad fallAsleep for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except BadWeight as ex:
-                    print(f"Bad weight for sub: {row["BidsFolder"]}, session: {row["SessionID"]} ({ex})")
-                    pass
-                except BadWakeUp:
-                    print(f"Bad wake up for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except UnableToParseHeight as ex:
-                    print(f"Unable to parse height for sub: {row["BidsFolder"]}, session: {row["SessionID"]} ({ex})")
-                    pass
-                except MissingSex:
-                    print(f"Missing sex for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except NoInfo:
-                    #print(f"Missing annotations/pre-sleep-q for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except ClientError:
-                    #print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
-                    pass
-                except Exception as exc:
-                    print(f"\033[1mException %s: %s\033[0m"%(row["BidsFolder"], exc))
-                    pass
-
-getSleepEffectivenessAndPreSleepQuestionnaire()
\ No newline at end of file
+    rows = pd.read_csv('bdsp_psg_master_20231101.csv')
+    pipeline = Pipeline(getInfoTask, computeTask, CHUNK_SIZE, 2, 2 * CHUNK_SIZE)
+
+    for row, future in pipeline.run(row for _, row in rows.iterrows()):
+        try:
+            
+            db.insertRow(future.result())
+
+        except MissingInterestInResearch:
+            print(f"Missing interest in research for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except UnableToComputeEffectiveness:
+            print(f"Unable to compute effectiveness for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except MissingSmoke:
+            print(f"Missing smoke for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except BadFallAsleep:
+            print(f"Bad fallAsleep for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except BadWeight as ex:
+            print(f"Bad weight for sub: {row["BidsFolder"]}, session: {row["SessionID"]} ({ex})")
+            pass
+        except BadWakeUp:
+            print(f"Bad wake up for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except UnableToParseHeight as ex:
+            print(f"Unable to parse height for sub: {row["BidsFolder"]}, session: {row["SessionID"]} ({ex})")
+            pass
+        except MissingSex:
+            print(f"Missing sex for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except NoInfo:
+            #print(f"Missing annotations/pre-sleep-q for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except ClientError:
+            #print(f"Missing data for sub: {row["BidsFolder"]}, session: {row["SessionID"]}")
+            pass
+        except Exception as exc:
+            print(f"\033[1mException %s: %s\033[0m"%(row["BidsFolder"], exc))
+            pass
+
+getSleepEffectivenessAndPreSleepQuestionnaire()
+
+if aws.getCacheStats() is not None:
+    print(f"Cache stats: {aws.getCacheStats()}")
+
+print(f"Pool stats: {aws.getPoolStats()}")